@@ -0,0 +1,306 @@
+"""Microbenchmarks for the order-sizing and persistence hot paths.
+
+Runs main_script against an in-process fake Binance client inside a scratch
+directory, so the live database and log are never touched, and prints the
+results as JSON:
+
+    python benchmark.py > bench.json
+    python benchmark.py --quick --latency 0.002
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeResponse:
+    def __init__(self):
+        self.headers = {'X-MBX-USED-WEIGHT-1M': '0'}
+        self.status_code = 200
+
+
+class FakeClient:
+    """Stand-in for binance.client.Client serving static market data and synthetic trade histories."""
+
+    latency = 0.0
+    positions = {}
+    trades = {}
+    order_ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def __init__(self, api_key=None, api_secret=None, requests_params=None, ping=True, **kwargs):
+        self.API_KEY = api_key
+        self.response = FakeResponse()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def close_connection(self):
+        pass
+
+    def futures_ping(self):
+        self._wait()
+        return {}
+
+    def futures_account(self):
+        self._wait()
+        return {'availableBalance': '1000', 'totalUnrealizedProfit': '1.5'}
+
+    def futures_exchange_info(self):
+        self._wait()
+        return {'symbols': [
+            {'symbol': 'GALAUSDT', 'quantityPrecision': 0, 'status': 'TRADING',
+             'filters': [{'filterType': 'LOT_SIZE', 'stepSize': '1', 'minQty': '1'}]},
+            {'symbol': 'BTCUSDT', 'quantityPrecision': 3, 'status': 'TRADING',
+             'filters': [{'filterType': 'LOT_SIZE', 'stepSize': '0.001', 'minQty': '0.001'}]}
+        ]}
+
+    def futures_mark_price(self, **kwargs):
+        self._wait()
+        now = int(time.time() * 1000)
+        return [{'symbol': 'GALAUSDT', 'markPrice': '0.05', 'time': now},
+                {'symbol': 'BTCUSDT', 'markPrice': '60000', 'time': now}]
+
+    def futures_position_information(self, **kwargs):
+        self._wait()
+        return [{'symbol': symbol, 'positionAmt': str(amount), 'entryPrice': '0.04', 'markPrice': '0.05',
+                 'unRealizedProfit': '1'} for symbol, amount in self.positions.get(self.API_KEY, {}).items()]
+
+    def futures_create_order(self, **kwargs):
+        self._wait()
+        with self.lock:
+            return {'orderId': next(self.order_ids)}
+
+    def futures_place_batch_order(self, batchOrders):
+        self._wait()
+        with self.lock:
+            return [{'orderId': next(self.order_ids), 'symbol': order['symbol']} for order in batchOrders]
+
+    def futures_account_trades(self, symbol=None, fromId=None, limit=500, **kwargs):
+        self._wait()
+        history = self.trades.get((self.API_KEY, symbol), [])
+        start = 0
+        if fromId is not None and history:
+            start = max(fromId - history[0]['id'], 0)
+        return history[start:start + limit]
+
+
+def summarize(samples, operations=1):
+    total = sum(samples)
+    ordered = sorted(samples)
+    return {
+        "iterations": len(samples),
+        "operations": operations * len(samples),
+        "total_s": round(total, 6),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 4),
+        "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, 4),
+        "ops_per_s": round(operations * len(samples) / total, 1) if total else None
+    }
+
+
+def measure(fn, iterations, operations=1, setup=None):
+    samples = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples, operations)
+
+
+def reset_state(m):
+    with m.orders_lock:
+        m.pending_orders.clear()
+        m.dirty_orders.clear()
+        m.closed_positions.clear()
+        m.lot_ledger.clear()
+        m.open_lots.clear()
+        m.dirty_lots.clear()
+        m.traded_symbols.clear()
+    with m.config_lock:
+        m.dirty_accounts.clear()
+    m.trade_cursors.clear()
+    m.balance_snapshots.clear()
+    m.order_generations.clear()
+    m.position_book.clear()
+
+
+def load_accounts(m, count):
+    for user_id in list(m.config_snapshot()):
+        m.remove_account(user_id)
+    FakeClient.positions = {}
+    for i in range(count):
+        m.set_account(f"bench{i}", {"api_key": f"key{i}", "api_secret": "secret", "status": 1,
+                                    "available_fund": 0.0, "live_pnl": 0.0, "multiplier": 1.0, "leverage": 2})
+        FakeClient.positions[f"key{i}"] = {"GALAUSDT": 4000, "BTCUSDT": 0.01}
+    m.build_account_clients(list(m.config_snapshot().items()))
+    reset_state(m)
+
+
+def bench_round_quantity(m, iterations):
+    cases = [(12345.6789, 1, 0), (0.0123456, 0.001, 3), (987.654321, 0.1, 1), (1e-05, 1e-05, 5)]
+    results = {}
+    for quantity, step_size, precision in cases:
+        def run():
+            for _ in range(1000):
+                m.round_quantity(quantity, step_size, precision)
+        results[f"{quantity}/{step_size}/{precision}"] = measure(run, iterations, operations=1000)
+    return results
+
+
+def bench_sizing(m, account_counts, iterations):
+    step = m.quantity_step(0.001, 3)
+    results = {}
+    for count in account_counts:
+        rows = [(1000.0 + i * 0.37, 1.0 + (i % 7) / 10, 2 + i % 5) for i in range(count)]
+
+        def per_account():
+            for balance, multiplier, leverage in rows:
+                quantity = balance * (10 / 100) * multiplier / 60000.0 * leverage
+                if quantity * 60000.0 >= 5:
+                    m.round_quantity(quantity, 0.001, 3)
+
+        results[f"round_quantity/{count}"] = measure(per_account, iterations, operations=count)
+        results[f"batch/{count}"] = measure(lambda: m.size_trade_batch(rows, 10.0, 60000.0, step), iterations, operations=count)
+    return results
+
+
+def bench_webhook(m, account_counts, iterations):
+    client = m.app.test_client()
+    payloads = {
+        "trade": {"token": "secret123", "symbol": "GALAUSDT", "side": "buy", "size": 10},
+        "close": {"token": "secret123", "symbol": "GALAUSDT", "action": "close", "percentage": 50},
+        "close_all": {"token": "secret123", "action": "close_all"}
+    }
+    results = {}
+    for count in account_counts:
+        load_accounts(m, count)
+        for action, payload in payloads.items():
+            def run():
+                response = client.post('/webhook', json=payload)
+                assert response.status_code == 200, response.get_data(as_text=True)
+                # A benchmark of the error path would look fast and mean nothing
+                assert all(result['status'] == "placed" for result in response.json['results']), response.json
+            results[f"{action}/{count}"] = measure(run, iterations, operations=count, setup=lambda: reset_state(m))
+    return results
+
+
+def bench_db_flush(m, sizes, iterations):
+    conn = m.get_db_connection()
+    conn.execute("PRAGMA synchronous=NORMAL")
+    results = {}
+    for size in sizes:
+        reset_state(m)
+        orders = [{"order_id": f"bench-{size}-{i}", "user_id": f"bench{i % 10}", "symbol": "GALAUSDT", "side": "BUY",
+                   "order_type": "MARKET", "price": 0.05, "quantity": 100.0, "size_usdt": 5.0, "status": "FILLED",
+                   "time": "2024-01-01 00:00:00"} for i in range(size)]
+
+        def queue_all():
+            m.pending_orders.update((order['order_id'], order) for order in orders)
+            m.dirty_orders.update((order['order_id'], order) for order in orders)
+
+        def queue_ten():
+            m.dirty_orders.update((order['order_id'], order) for order in orders[:10])
+
+        results[f"full/{size}"] = measure(lambda: m.flush_pending_writes(conn), iterations, operations=size, setup=queue_all)
+        # Steady state: a handful of new rows while pending_orders holds the whole backlog
+        results[f"incremental/{size}"] = measure(lambda: m.flush_pending_writes(conn), iterations, operations=10, setup=queue_ten)
+    conn.close()
+    return results
+
+
+def synthetic_history(m, user_id, api_key, symbol, pairs, first_id):
+    history = []
+    for i in range(pairs):
+        order_id = str(first_id + 2 * i)
+        m.add_lot({"order_id": order_id, "user_id": user_id, "symbol": symbol, "side": "BUY", "quantity": 100.0, "price": 0.05})
+        for offset, side, price, pnl in ((0, "BUY", 0.05, 0.0), (1, "SELL", 0.06, 1.0)):
+            history.append({"id": first_id + 2 * i + offset, "orderId": first_id + 2 * i + offset, "symbol": symbol,
+                            "side": side, "qty": "100", "price": str(price), "realizedPnl": str(pnl),
+                            "time": 1700000000000 + (2 * i + offset) * 1000})
+    FakeClient.trades[(api_key, symbol)] = history
+    m.traded_symbols.setdefault(user_id, set()).add(symbol)
+
+
+def bench_sync(m, history_sizes, iterations, accounts=10):
+    results = {}
+    for pairs in history_sizes:
+        load_accounts(m, accounts)
+
+        def seed():
+            reset_state(m)
+            FakeClient.trades = {}
+            for i, (user_id, config) in enumerate(m.config_snapshot().items()):
+                synthetic_history(m, user_id, config['api_key'], "GALAUSDT", pairs, 1_000_000 * (i + 1))
+
+        results[f"backlog/{pairs}"] = measure(m.sync_closed_positions, iterations, operations=accounts * pairs, setup=seed)
+        # Cursors are now at the head of every history, so this is the idle polling cost
+        results[f"caught_up/{pairs}"] = measure(m.sync_closed_positions, iterations, operations=accounts)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="fewer iterations and smaller inputs")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per fake Binance call")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    iterations = 3 if args.quick else 20
+    account_counts = [1, 10] if args.quick else [1, 10, 100]
+    flush_sizes = [100, 1000] if args.quick else [100, 1000, 10000]
+    history_sizes = [10, 100] if args.quick else [10, 100, 1000]
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="tv2-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main_script as m
+
+    m.logger.setLevel(logging.ERROR)
+    m.Client = FakeClient
+    FakeClient.latency = args.latency
+    m.CONFIG["webhook_intake_mode"] = "sync"
+    m.CONFIG["max_api_weight"] = 10 ** 9
+    m.initialize_database()
+    m.load_exchange_info()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency_s": args.latency,
+            "dispatch_mode": m.CONFIG["webhook_dispatch_mode"],
+            "workdir": workdir,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "round_quantity": bench_round_quantity(m, iterations),
+        "sizing": bench_sizing(m, [100, 10000] if args.quick else [100, 10000, 100000], iterations),
+        "webhook": bench_webhook(m, account_counts, iterations),
+        "db_flush": bench_db_flush(m, flush_sizes, iterations),
+        "sync_closed_positions": bench_sync(m, history_sizes, max(iterations // 4, 1))
+    }
+    m.shutdown_event.set()
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
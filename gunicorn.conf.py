@@ -0,0 +1,18 @@
+# Production serving: gunicorn -c gunicorn.conf.py main_script:app
+# gunicorn needs a POSIX host; on Windows keep using python main_script.py (single process).
+# Every worker serves HTTP, and the one holding the "background" lease in trading_data.db
+# trades and runs the polling loops; see start_worker() in main_script.py.
+# /metrics can be scraped through any worker: each one publishes its series to SharedState
+# and the answer covers every live worker, labelled worker="<host>-<pid>".
+bind = "0.0.0.0:5000"
+workers = 4
+# The /events dashboard stream keeps a connection open, so each worker needs spare threads
+worker_class = "gthread"
+threads = 8
+timeout = 60
+graceful_timeout = 20
+
+
+def post_worker_init(worker):
+    import main_script
+    main_script.start_worker()
@@ -1,17 +1,33 @@
+import atexit
+import hashlib
+import itertools
+import json
+import math
+import os
+import queue
+import socket
 import sqlite3
 import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal, ROUND_DOWN
-from flask import Flask, request, jsonify, render_template, flash, redirect, url_for
+from flask import Flask, request, jsonify, render_template, flash, redirect, url_for, Response, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from binance.client import Client
 from binance.exceptions import BinanceAPIException
 from concurrent_log_handler import ConcurrentRotatingFileHandler
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import requests.exceptions
 from flask_caching import Cache
+from websockets.sync.client import connect as ws_connect
 
 # Set up logging
 logger = logging.getLogger('trading_app')
@@ -21,17 +37,40 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.addHandler(stream_handler)
-
-log_lock = threading.Lock()
-
-def log_message(level, message):
-    with log_lock:
-        if level == 'INFO':
-            logger.info(message)
-        elif level == 'ERROR':
-            logger.error(message)
+log_listener = None
+log_sample_counters = {}
+
+# Messages arrive already built from f-strings, so the record can go on the queue untouched
+# and the writer thread does the formatting
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+def setup_logging(mode):
+    global log_listener
+    if mode != "queued":
+        logger.addHandler(handler)
+        logger.addHandler(stream_handler)
+        return
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, handler, stream_handler)
+    log_listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        # Stopping drains everything already queued before the writer exits
+        log_listener.stop()
+        log_listener = None
+
+def log_message(level, message, chatty=False):
+    if chatty:
+        every = CONFIG["log_sample_every"].get(level, 1)
+        if every > 1 and next(log_sample_counters.setdefault(level, itertools.count())) % every:
+            return
+    logger.log(logging.getLevelName(level), message)
 
 # Utility function to round quantity to the correct step size and precision
 def round_quantity(quantity, step_size, precision):
@@ -40,15 +79,128 @@ def round_quantity(quantity, step_size, precision):
     rounded_quantity = (quantity_decimal // step_size_decimal) * step_size_decimal
     return float(rounded_quantity.quantize(Decimal(f'0.{"0" * precision}'), rounding=ROUND_DOWN))
 
+DECIMAL_LIMIT = 10 ** 28
+
+# A float's repr is the shortest decimal that round-trips, which is exactly what Decimal(str(x))
+# sees, so it can be split into an integer mantissa and a power-of-ten exponent directly
+def decimal_parts(value):
+    text = repr(value)
+    if 'e' in text or 'n' in text:
+        sign, digits, exponent = Decimal(text).as_tuple()
+        if not isinstance(exponent, int):
+            return None
+        mantissa = int(''.join(map(str, digits)))
+        if sign:
+            mantissa = -mantissa
+        if exponent > 0:
+            return mantissa * 10 ** exponent, 0
+        return mantissa, -exponent
+    whole, _, fraction = text.partition('.')
+    return int(whole + fraction), len(fraction)
+
+def quantity_step(step_size, precision):
+    parts = decimal_parts(step_size)
+    if parts is None or parts[0] <= 0:
+        return None
+    step_units, step_exp = parts
+    return (step_size, step_units, step_exp, precision, 10 ** step_exp,
+            DECIMAL_LIMIT // 10 ** max(precision - step_exp, 0))
+
+# Fixed-point equivalent of round_quantity for a precomputed quantity_step: Decimal's // truncates
+# toward zero and quantize(ROUND_DOWN) cuts extra digits, so both are done on the magnitude
+def quantize_quantity(quantity, step):
+    step_size, step_units, step_exp, precision, scale, limit = step
+    if quantity > 0 and math.isfinite(quantity):
+        # Int/int division rounds correctly, so a guess strictly bracketed by its two grid points
+        # as floats is the exact step count; anything that lands on a grid point takes the slow path
+        steps = int(quantity / step_size)
+        units = steps * step_units
+        lower = units / scale
+        if lower < quantity < (units + step_units) / scale and units < limit:
+            if precision < step_exp:
+                return units // 10 ** (step_exp - precision) / 10 ** precision
+            return lower
+    parts = decimal_parts(quantity)
+    if parts is None:
+        return round_quantity(quantity, step_size, precision)
+    units, exp = parts
+    scale = max(exp, step_exp)
+    value = (abs(units) * 10 ** (scale - exp)) // (step_units * 10 ** (scale - step_exp)) * step_units
+    # Past Decimal's 28 digits round_quantity raises or rounds, so leave those to it
+    if value * 10 ** max(precision - step_exp, 0) >= DECIMAL_LIMIT:
+        return round_quantity(quantity, step_size, precision)
+    if precision < step_exp:
+        value //= 10 ** (step_exp - precision)
+        result = value / 10 ** precision
+    else:
+        result = value / 10 ** step_exp
+    return -result if repr(quantity).startswith('-') else result
+
+# Sizes a trade for many accounts in one pass. Each row is (balance, multiplier, leverage); the float
+# steps match the original per-account arithmetic so quantities come out identical. Returns
+# (notional_value, quantity) per row, with quantity None when the order is under the 5 USDT minimum.
+def size_trade_batch(rows, size, price, step, futures=True):
+    fraction = size / 100
+    sized = []
+    for balance, multiplier, leverage in rows:
+        quantity = balance * fraction * multiplier / price
+        if futures:
+            quantity *= leverage
+            notional_value = quantity * price
+            if notional_value < 5:
+                sized.append((notional_value, None))
+                continue
+        else:
+            notional_value = quantity * price
+        sized.append((notional_value, quantize_quantity(quantity, step)))
+    return sized
+
 # Global variables
 slave_accounts = []
 current_positions = {}
 current_config = {}
-pending_orders = []
+pending_orders = {}
 closed_positions = []
 all_closed_positions = []
-data_lock = threading.Lock()
+config_lock = threading.Lock()
+account_locks = {}
+orders_lock = threading.Lock()
+dirty_accounts = set()
+dirty_orders = {}
+db_flush_event = threading.Event()
+sync_lock = threading.Lock()
+sync_event = threading.Event()
+trade_cursors = {}
+traded_symbols = {}
+lot_ledger = {}
+open_lots = {}
+dirty_lots = {}
+balance_snapshots = {}
+order_generations = {}
+position_book = {}
+exchange_info_cache = {}
+exchange_info_loaded_at = 0.0
+exchange_info_lock = threading.Lock()
+price_cache = {}
+price_poll_lock = threading.Lock()
+api_weight_used = 0
+last_weight_reset = 0.0
+weight_banned_until = 0.0
+account_weight_used = {}
+account_order_counts = {}
+weight_lock = threading.Lock()
+histograms = {}
+counters = {}
+metrics_lock = threading.Lock()
 shutdown_event = threading.Event()
+warmup_event = threading.Event()
+warmup_state = {"stage": "starting", "started_at": None, "finished_at": None,
+                "accounts_total": 0, "accounts_done": 0, "errors": []}
+warmup_lock = threading.Lock()
+owner_event = threading.Event()
+lease_checked = threading.Event()
+shared_versions = {}
+published_state = {}
 thread_status = {
     "db_updater": True,
     "balance_updater": True,
@@ -63,9 +215,86 @@ CONFIG = {
     "max_retries": 3,
     "max_backoff": 30,
     "max_api_weight": 1200,
-    "weight_reset_interval": 60
+    "weight_reset_interval": 60,
+    "weight_read_share": 0.8,
+    "weight_background_share": 0.6,
+    "webhook_dispatch_mode": "parallel",
+    "webhook_workers": 16,
+    "client_keepalive_interval": 30,
+    "exchange_info_ttl": 3600,
+    "mark_price_stream_url": "wss://fstream.binance.com/ws/!markPrice@arr@1s",
+    "mark_price_stream_reconnect": 5,
+    "price_max_age": 5,
+    "webhook_intake_mode": "async",
+    "webhook_queue_size": 100,
+    "max_tracked_jobs": 1000,
+    "page_size": 200,
+    "max_page_size": 1000,
+    "event_refresh_interval": 5,
+    "event_queue_size": 100,
+    "balance_max_staleness": 10,
+    "position_refresh_interval": 15,
+    "open_position_refresh_interval": 3,
+    "position_scheduler_tick": 1,
+    "position_force_refresh": False,
+    "log_mode": "queued",
+    "log_sample_every": {"INFO": 10},
+    "batch_order_size": 5,
+    "serve_mode": "development",
+    "lease_ttl": 15,
+    "shared_state_interval": 1,
+    "shared_job_poll_interval": 0.05,
+    "event_relay_size": 200,
+    "metrics_publish_interval": 5,
+    "idempotency_ttl": 86400,
+    "idempotency_window": 0,
+    "idempotency_cache_size": 10000,
+    "coalesce_window": 0,
+    "backfill_batch_size": 200,
+    "backfill_poll_interval": 5
+}
+
+setup_logging(CONFIG["log_mode"])
+
+PRIORITY_ORDER = 0
+PRIORITY_READ = 1
+PRIORITY_BACKGROUND = 2
+
+API_WEIGHTS = {
+    "futures_account": 5,
+    "futures_position_information": 5,
+    "futures_account_trades": 5,
+    "futures_mark_price": 10,
+    "futures_place_batch_order": 5,
+    "get_account": 20,
+    "get_symbol_info": 20,
+    "futures_exchange_info": 1
 }
 
+class WeightBudgetExceeded(Exception):
+    pass
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+account_clients = {}
+client_lock = threading.Lock()
+market_client = None
+
+event_subscribers = []
+events_lock = threading.Lock()
+relay_events = []
+
+webhook_queue = queue.Queue(maxsize=CONFIG["webhook_queue_size"])
+webhook_jobs = OrderedDict()
+jobs_lock = threading.Lock()
+idempotency_cache = OrderedDict()
+idempotency_lock = threading.Lock()
+backfill_event = threading.Event()
+
+order_executor = ThreadPoolExecutor(max_workers=CONFIG["webhook_workers"], thread_name_prefix="order-worker")
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
 login_manager = LoginManager()
@@ -98,6 +327,7 @@ def get_db_connection(db_file="trading_data.db"):
 def initialize_database(db_file="trading_data.db"):
     with get_db_connection(db_file) as conn:
         cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute('''CREATE TABLE IF NOT EXISTS Config (
             user_id TEXT PRIMARY KEY,
             api_key TEXT NOT NULL,
@@ -131,11 +361,103 @@ def initialize_database(db_file="trading_data.db"):
             realized_pnl REAL,
             close_time TEXT
         )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS TradeCursors (
+            user_id TEXT,
+            symbol TEXT,
+            last_trade_id INTEGER,
+            PRIMARY KEY (user_id, symbol)
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS OpenLots (
+            order_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            symbol TEXT,
+            side TEXT,
+            quantity REAL,
+            price REAL,
+            time TEXT
+        )''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS Users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE,
             password_hash TEXT
         )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS SharedState (
+            key TEXT PRIMARY KEY,
+            version INTEGER DEFAULT 0,
+            payload TEXT,
+            updated_at REAL
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS Jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT,
+            action TEXT,
+            market TEXT,
+            data TEXT,
+            submitted_at TEXT,
+            queued_at REAL,
+            finished_at TEXT,
+            status_code INTEGER,
+            result TEXT
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_time ON Orders (time, order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_time ON Orders (user_id, time, order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_symbol_time ON Orders (user_id, symbol, time, order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_symbol_time ON Orders (symbol, time, order_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_closed_positions_close_time ON ClosedPositions (close_time)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_closed_positions_user ON ClosedPositions (user_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_closed_positions_user_symbol ON ClosedPositions (user_id, symbol, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_closed_positions_symbol ON ClosedPositions (symbol, id)")
+        cursor.execute('''CREATE TABLE IF NOT EXISTS WebhookKeys (
+            key TEXT PRIMARY KEY,
+            job_id TEXT,
+            expires_at REAL,
+            status_code INTEGER,
+            result TEXT
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS PnlRollup (
+            user_id TEXT,
+            symbol TEXT,
+            day TEXT,
+            trades INTEGER DEFAULT 0,
+            wins INTEGER DEFAULT 0,
+            losses INTEGER DEFAULT 0,
+            realized_pnl REAL DEFAULT 0,
+            gross_profit REAL DEFAULT 0,
+            gross_loss REAL DEFAULT 0,
+            PRIMARY KEY (user_id, symbol, day)
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS BackfillJobs (
+            kind TEXT PRIMARY KEY,
+            status TEXT,
+            cursor INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            updated INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON Jobs (status, queued_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_keys_job ON WebhookKeys (job_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_keys_expires ON WebhookKeys (expires_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pnl_rollup_day ON PnlRollup (day)")
+        # Databases from before the rollup existed get it built once from the full history;
+        # from then on flush_pending_writes keeps it current
+        cursor.execute('''INSERT INTO PnlRollup (user_id, symbol, day, trades, wins, losses, realized_pnl, gross_profit, gross_loss)
+            SELECT user_id, symbol, COALESCE(substr(close_time, 1, 10), ''), COUNT(*),
+                SUM(realized_pnl > 0), SUM(realized_pnl < 0), TOTAL(realized_pnl),
+                TOTAL(MAX(realized_pnl, 0)), TOTAL(MIN(realized_pnl, 0))
+            FROM ClosedPositions WHERE NOT EXISTS (SELECT 1 FROM PnlRollup)
+            GROUP BY user_id, symbol, COALESCE(substr(close_time, 1, 10), '')''')
+        if cursor.rowcount > 0:
+            log_message('INFO', f"Built PnL rollup with {cursor.rowcount} groups from existing closed positions")
         conn.commit()
         # Validate schema
         cursor.execute("PRAGMA table_info(Orders)")
@@ -152,101 +474,987 @@ def initialize_database(db_file="trading_data.db"):
             log_message('ERROR', f"ClosedPositions table is missing required columns: {missing_columns}. Please migrate the database schema.")
         log_message('INFO', "Database initialized successfully")
 
+def get_account_lock(user_id):
+    with config_lock:
+        return account_locks.setdefault(user_id, threading.Lock())
+
+# current_config is copy-on-write: readers keep whatever snapshot they grabbed, writers swap in a new dict
+def config_snapshot():
+    return current_config
+
+def set_account(user_id, config):
+    global current_config
+    with config_lock:
+        snapshot = dict(current_config)
+        snapshot[user_id] = config
+        current_config = snapshot
+        dirty_accounts.add(user_id)
+
+def update_account(user_id, **fields):
+    global current_config
+    with config_lock:
+        if user_id not in current_config:
+            return False
+        snapshot = dict(current_config)
+        snapshot[user_id] = {**snapshot[user_id], **fields}
+        current_config = snapshot
+        dirty_accounts.add(user_id)
+    return True
+
+def remove_account(user_id):
+    global current_config
+    with config_lock:
+        if user_id not in current_config:
+            return False
+        snapshot = dict(current_config)
+        del snapshot[user_id]
+        current_config = snapshot
+        account_locks.pop(user_id, None)
+        dirty_accounts.discard(user_id)
+    return True
+
+def reset_weight_window(now):
+    global api_weight_used, last_weight_reset
+    if now - last_weight_reset >= CONFIG["weight_reset_interval"]:
+        api_weight_used = 0
+        last_weight_reset = now - now % CONFIG["weight_reset_interval"]
+        account_weight_used.clear()
+        account_order_counts.clear()
+
+def priority_label(priority):
+    return {PRIORITY_ORDER: "order", PRIORITY_READ: "read", PRIORITY_BACKGROUND: "background"}[priority]
+
+def reserve_weight(weight, priority, user_id=None, defer=False):
+    global api_weight_used
+    share = {PRIORITY_ORDER: 1.0, PRIORITY_READ: CONFIG["weight_read_share"],
+             PRIORITY_BACKGROUND: CONFIG["weight_background_share"]}[priority]
+    while True:
+        with weight_lock:
+            now = time.time()
+            reset_weight_window(now)
+            banned = now < weight_banned_until and priority != PRIORITY_ORDER
+            if not banned and api_weight_used + weight <= CONFIG["max_api_weight"] * share:
+                api_weight_used += weight
+                if user_id is not None:
+                    account_weight_used[user_id] = account_weight_used.get(user_id, 0) + weight
+                return
+            resume_at = weight_banned_until if banned else last_weight_reset + CONFIG["weight_reset_interval"]
+        if not defer or shutdown_event.is_set():
+            raise WeightBudgetExceeded(f"API weight budget exhausted ({api_weight_used}/{CONFIG['max_api_weight']}), rejected {priority_label(priority)} call")
+        shutdown_event.wait(max(resume_at - time.time(), 0.1))
+
+def record_weight(client, user_id=None):
+    global api_weight_used
+    response = getattr(client, 'response', None)
+    if response is None:
+        return
+    used = response.headers.get('X-MBX-USED-WEIGHT-1M')
+    orders = response.headers.get('X-MBX-ORDER-COUNT-1M')
+    with weight_lock:
+        reset_weight_window(time.time())
+        if used is not None:
+            api_weight_used = max(api_weight_used, int(used))
+        if orders is not None and user_id is not None:
+            account_order_counts[user_id] = int(orders)
+
+def note_rate_limit(error):
+    global weight_banned_until
+    retry_after = 60
+    response = getattr(error, 'response', None)
+    if response is not None and response.headers.get('Retry-After'):
+        retry_after = int(response.headers['Retry-After'])
+    with weight_lock:
+        weight_banned_until = max(weight_banned_until, time.time() + retry_after)
+    log_message('ERROR', f"Binance rate limit hit (HTTP {error.status_code}), holding non-order calls for {retry_after}s")
+
+def api_call(client, method, *args, priority=PRIORITY_READ, user_id=None, defer=False, **kwargs):
+    reserve_weight(API_WEIGHTS.get(method, 1), priority, user_id, defer)
+    try:
+        return getattr(client, method)(*args, **kwargs)
+    except BinanceAPIException as e:
+        if e.status_code in (418, 429):
+            note_rate_limit(e)
+        raise
+    finally:
+        # Spot endpoints report against a separate limit, so only futures headers feed the budget
+        if method.startswith("futures_"):
+            record_weight(client, user_id)
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0}
+        histogram["buckets"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram["sum"] += seconds
+
+def increment(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+@contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def metrics_snapshot():
+    with metrics_lock:
+        histogram_items = [[name, labels, list(value["buckets"]), value["sum"]] for (name, labels), value in histograms.items()]
+        counter_items = [[name, labels, value] for (name, labels), value in counters.items()]
+    gauges = {
+        "tv2_active_accounts": sum(1 for config in config_snapshot().values() if config['status']),
+        "tv2_pending_orders": len(pending_orders),
+        "tv2_webhook_queue_depth": webhook_queue.qsize(),
+        "tv2_api_weight_used": api_weight_used
+    }
+    return {"histograms": histogram_items, "counters": counter_items, "gauges": gauges}
+
+# Each snapshot comes with labels added to all of its series (the worker, under gunicorn); series of
+# one name are kept together since the exposition format expects a single block per metric
+def render_metrics(snapshots):
+    histogram_items = []
+    counter_items = []
+    gauge_items = []
+    for extra, snapshot in snapshots:
+        histogram_items += [(name, extra + tuple(map(tuple, labels)), buckets, total)
+                            for name, labels, buckets, total in snapshot["histograms"]]
+        counter_items += [(name, extra + tuple(map(tuple, labels)), value) for name, labels, value in snapshot["counters"]]
+        gauge_items += [(name, extra, value) for name, value in snapshot["gauges"].items()]
+    lines = []
+    typed = set()
+    for name, labels, buckets, total in sorted(histogram_items):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    for name, labels, value in sorted(counter_items):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, labels, value in sorted(gauge_items):
+        if name not in typed:
+            lines.append(f"# TYPE {name} gauge")
+            typed.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+# Under gunicorn a scrape lands on any worker, and the webhook, sync and flush series only exist on the
+# lease owner. Every worker publishes its own snapshot, and /metrics serves all of the live ones with a
+# worker label, so each series stays continuous whichever worker answers.
+def publish_metrics(conn):
+    now = time.time()
+    with conn:
+        conn.execute("""INSERT INTO SharedState (key, version, payload, updated_at) VALUES (?, 1, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET version = SharedState.version + 1, payload = excluded.payload,
+            updated_at = excluded.updated_at""", (f"metrics:{WORKER_ID}", json.dumps(metrics_snapshot()), now))
+        # A worker that stopped publishing is gone, and its counters with it
+        conn.execute("DELETE FROM SharedState WHERE key LIKE 'metrics:%' AND updated_at < ?",
+                     (now - 3 * CONFIG["metrics_publish_interval"],))
+
+def worker_metrics():
+    snapshots = {WORKER_ID: metrics_snapshot()}
+    with get_db_connection() as conn:
+        for key, payload in conn.execute("SELECT key, payload FROM SharedState WHERE key LIKE 'metrics:%'"):
+            snapshots.setdefault(key[len("metrics:"):], json.loads(payload))
+    return [((("worker", worker),), snapshot) for worker, snapshot in snapshots.items()]
+
+def build_client(user_id, api_key, api_secret):
+    client = Client(api_key, api_secret, requests_params={"timeout": 20})
+    # Open the futures connection up front so the first order skips the TLS handshake
+    api_call(client, "futures_ping", priority=PRIORITY_ORDER, user_id=user_id)
+    with client_lock:
+        previous = account_clients.get(user_id)
+        account_clients[user_id] = client
+    if previous is not None and previous is not client:
+        previous.close_connection()
+    return client
+
+def get_client(user_id, config):
+    client = account_clients.get(user_id)
+    if client is None or client.API_KEY != config['api_key']:
+        client = build_client(user_id, config['api_key'], config['api_secret'])
+    return client
+
+def drop_client(user_id):
+    with client_lock:
+        client = account_clients.pop(user_id, None)
+    if client is not None:
+        client.close_connection()
+
+# Accounts deleted or re-keyed elsewhere (another worker's route) would otherwise keep their old client,
+# and client_keepalive would go on pinging it
+def prune_clients(accounts):
+    with client_lock:
+        stale = [user_id for user_id, client in account_clients.items()
+                 if user_id not in accounts or client.API_KEY != accounts[user_id]['api_key']]
+    for user_id in stale:
+        drop_client(user_id)
+
+def build_account_clients(accounts):
+    def build(item):
+        user_id, config = item
+        try:
+            build_client(user_id, config['api_key'], config['api_secret'])
+        except Exception as e:
+            log_message('ERROR', f"Failed to build Binance client for {user_id}: {e}")
+    list(order_executor.map(build, accounts))
+
+def get_market_client():
+    global market_client
+    if market_client is None:
+        market_client = Client(requests_params={"timeout": 20}, ping=False)
+    return market_client
+
+def load_exchange_info():
+    global exchange_info_cache, exchange_info_loaded_at
+    info = api_call(get_market_client(), "futures_exchange_info", priority=PRIORITY_ORDER)
+    index = {}
+    for sym in info['symbols']:
+        if sym.get('status', 'TRADING') != 'TRADING':
+            continue
+        filters = {"stepSize": None, "precision": sym.get('quantityPrecision', 0), "minNotional": None, "tickSize": None}
+        for filt in sym['filters']:
+            if filt['filterType'] == 'LOT_SIZE':
+                filters['stepSize'] = float(filt['stepSize'])
+                filters['step'] = quantity_step(filters['stepSize'], filters['precision'])
+            elif filt['filterType'] == 'PRICE_FILTER':
+                filters['tickSize'] = float(filt['tickSize'])
+            elif filt['filterType'] == 'MIN_NOTIONAL':
+                filters['minNotional'] = float(filt.get('notional', filt.get('minNotional', 0)))
+        if filters['stepSize'] is not None and filters['step'] is not None:
+            index[sym['symbol']] = filters
+    exchange_info_cache = index
+    exchange_info_loaded_at = time.time()
+    log_message('INFO', f"Loaded exchange filters for {len(index)} futures symbols")
+
+def get_symbol_filters(symbol):
+    # Followers wait for the owner to publish the filters rather than calling futures_exchange_info
+    if not exchange_info_cache and owns_background():
+        with exchange_info_lock:
+            if not exchange_info_cache:
+                try:
+                    load_exchange_info()
+                except Exception as e:
+                    log_message('ERROR', f"Failed to load futures exchange info: {e}")
+    return exchange_info_cache.get(symbol)
+
+def get_quantity_step(client, symbol, market="futures"):
+    if market == "futures":
+        filters = get_symbol_filters(symbol)
+        return filters['step'] if filters is not None else None
+    info = api_call(client, "get_symbol_info", symbol, priority=PRIORITY_ORDER)
+    for filt in info['filters']:
+        if filt['filterType'] == 'LOT_SIZE':
+            return quantity_step(float(filt['stepSize']), info.get('quantityPrecision', 0))
+    return None
+
+def exchange_info_refresher():
+    while not shutdown_event.is_set():
+        threading.Event().wait(CONFIG["exchange_info_ttl"])
+        if not owns_background():
+            continue
+        try:
+            with exchange_info_lock:
+                load_exchange_info()
+        except Exception as e:
+            log_message('ERROR', f"Failed to refresh futures exchange info: {e}")
+
+def cache_mark_prices(entries):
+    now = time.time()
+    for entry in entries:
+        symbol = entry.get('s', entry.get('symbol'))
+        price = float(entry.get('p', entry.get('markPrice', 0)))
+        if symbol and price > 0:
+            price_cache[symbol] = (price, now)
+
+def poll_mark_prices():
+    cache_mark_prices(api_call(get_market_client(), "futures_mark_price", priority=PRIORITY_ORDER))
+
+def cached_mark_price(symbol, max_age=None):
+    max_age = CONFIG["price_max_age"] if max_age is None else max_age
+    cached = price_cache.get(symbol)
+    if cached and time.time() - cached[1] <= max_age:
+        return cached[0]
+    return None
+
+def get_mark_price(symbol, max_age=None):
+    price = cached_mark_price(symbol, max_age)
+    if price is not None:
+        return price
+    # One batched poll refreshes every symbol; concurrent callers wait for it instead of polling again
+    with price_poll_lock:
+        price = cached_mark_price(symbol, max_age)
+        if price is None:
+            poll_mark_prices()
+            price = cached_mark_price(symbol, max_age)
+    if price is None:
+        raise Exception(f"No mark price available for {symbol}")
+    return price
+
+def get_signal_price(symbol, market):
+    for attempt in range(CONFIG["max_retries"]):
+        try:
+            if market == "futures":
+                price = get_mark_price(symbol)
+            else:
+                price = float(api_call(get_market_client(), "get_symbol_ticker", symbol=symbol, priority=PRIORITY_ORDER)['price'])
+            if price > 0:
+                return price
+        except Exception as e:
+            log_message('ERROR', f"Failed to fetch price for {symbol} (attempt {attempt + 1}/{CONFIG['max_retries']}): {e}")
+        if attempt < CONFIG["max_retries"] - 1:
+            threading.Event().wait(1)
+    raise Exception(f"Failed to fetch price for {symbol} after {CONFIG['max_retries']} attempts")
+
+def mark_price_stream(url=None):
+    while not shutdown_event.is_set():
+        try:
+            with ws_connect(url or CONFIG["mark_price_stream_url"], open_timeout=10) as ws:
+                log_message('INFO', "Connected to mark price stream")
+                while not shutdown_event.is_set():
+                    message = json.loads(ws.recv(timeout=30))
+                    if isinstance(message, dict):
+                        message = message.get('data', message)
+                    cache_mark_prices(message if isinstance(message, list) else [message])
+        except Exception as e:
+            log_message('ERROR', f"Mark price stream disconnected: {e}")
+        shutdown_event.wait(CONFIG["mark_price_stream_reconnect"])
+
+def client_keepalive():
+    while not shutdown_event.is_set():
+        threading.Event().wait(CONFIG["client_keepalive_interval"])
+        if not owns_background():
+            continue
+        with client_lock:
+            clients = list(account_clients.items())
+        for user_id, client in clients:
+            try:
+                api_call(client, "futures_ping", priority=PRIORITY_BACKGROUND, user_id=user_id)
+            except Exception as e:
+                log_message('ERROR', f"Keepalive ping failed for {user_id}: {e}")
+
+def record_orders(orders):
+    with orders_lock:
+        for order in orders:
+            balance_snapshots.pop(order['user_id'], None)
+            order_generations[order['user_id']] = order_generations.get(order['user_id'], 0) + 1
+            position_book.pop(order['user_id'], None)
+            pending_orders[order['order_id']] = order
+            dirty_orders[order['order_id']] = order
+            traded_symbols.setdefault(order['user_id'], set()).add(order['symbol'])
+            if not order.get('reduce_only'):
+                add_lot(order)
+    db_flush_event.set()
+    publish_event("order_placed", [{k: v for k, v in order.items() if k != 'reduce_only'} for order in orders])
+
+# Open entry lots per (user_id, symbol) in fill order; callers hold orders_lock
+def add_lot(order):
+    lot = {"order_id": order['order_id'], "user_id": order['user_id'], "symbol": order['symbol'], "side": order['side'],
+           "quantity": order['quantity'], "price": order['price'], "time": order.get('time')}
+    lot_ledger.setdefault((order['user_id'], order['symbol']), deque()).append(lot)
+    open_lots[order['order_id']] = lot
+    dirty_lots[order['order_id']] = lot
+
+def release_lot(lot, quantity):
+    lot['quantity'] = max(lot['quantity'] - quantity, 0.0)
+    dirty_lots[lot['order_id']] = lot
+    if lot['quantity'] <= 1e-12:
+        open_lots.pop(lot['order_id'], None)
+        pending_orders.pop(lot['order_id'], None)
+
+# Lots are persisted so whichever worker owns the background loops next can rebuild the ledger;
+# callers hold orders_lock
+def take_dirty_lots(key=None):
+    order_ids = [order_id for order_id, lot in dirty_lots.items() if key is None or (lot['user_id'], lot['symbol']) == key]
+    return [dirty_lots.pop(order_id) for order_id in order_ids]
+
+def restore_dirty_lots(lots):
+    for lot in lots:
+        dirty_lots.setdefault(lot['order_id'], lot)
+
+def write_lots(conn, lots):
+    conn.executemany('''INSERT INTO OpenLots (order_id, user_id, symbol, side, quantity, price, time)
+        VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(order_id) DO UPDATE SET quantity = excluded.quantity''',
+        [(lot['order_id'], lot['user_id'], lot['symbol'], lot['side'], lot['quantity'], lot['price'], lot['time'])
+         for lot in lots if lot['quantity'] > 1e-12])
+    conn.executemany("DELETE FROM OpenLots WHERE order_id = ?", [(lot['order_id'],) for lot in lots if lot['quantity'] <= 1e-12])
+
+def load_open_lots(db_file="trading_data.db"):
+    with get_db_connection(db_file) as conn:
+        lots = [dict(row) for row in conn.execute("SELECT order_id, user_id, symbol, side, quantity, price, time FROM OpenLots ORDER BY rowid")]
+        orders = [dict(row) for row in conn.execute("SELECT * FROM Orders WHERE order_id IN (SELECT order_id FROM OpenLots)")]
+    with orders_lock:
+        lot_ledger.clear()
+        open_lots.clear()
+        dirty_lots.clear()
+        for lot in lots:
+            lot_ledger.setdefault((lot['user_id'], lot['symbol']), deque()).append(lot)
+            open_lots[lot['order_id']] = lot
+            traded_symbols.setdefault(lot['user_id'], set()).add(lot['symbol'])
+        for order in orders:
+            pending_orders.setdefault(order['order_id'], order)
+    log_message('INFO', f"Loaded {len(lots)} open lots")
+
+def match_exit(user_id, symbol, side, quantity):
+    lots = lot_ledger.get((user_id, symbol))
+    matched = 0.0
+    cost = 0.0
+    while lots and quantity - matched > 1e-12:
+        lot = lots[0]
+        if lot['quantity'] <= 1e-12:
+            lots.popleft()
+            continue
+        if lot['side'] == side:
+            break
+        take = min(lot['quantity'], quantity - matched)
+        matched += take
+        cost += take * (lot['price'] or 0.0)
+        release_lot(lot, take)
+        if lot['quantity'] <= 1e-12:
+            lots.popleft()
+    if lots is not None and not lots:
+        del lot_ledger[(user_id, symbol)]
+    return matched, (cost / matched if matched and cost else None)
+
+def flush_pending_writes(conn):
+    with config_lock:
+        accounts = [(user_id, current_config[user_id]) for user_id in dirty_accounts if user_id in current_config]
+        dirty_accounts.clear()
+    with orders_lock:
+        orders = list(dirty_orders.values())
+        dirty_orders.clear()
+        closed = list(closed_positions)
+        lots = take_dirty_lots()
+    if not (accounts or orders or closed or lots):
+        return 0
+    try:
+        with conn:
+            # Routes create, edit and delete Config rows themselves, possibly from another worker, so
+            # only the balance columns are written from here and a deleted account stays deleted
+            conn.executemany("UPDATE Config SET available_fund = ?, live_pnl = ? WHERE user_id = ?",
+                [(config['available_fund'], config['live_pnl'], user_id) for user_id, config in accounts])
+            conn.executemany('''INSERT OR REPLACE INTO Orders 
+                (order_id, user_id, symbol, side, order_type, price, quantity, size_usdt, status, time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                [(order['order_id'], order['user_id'], order['symbol'], order['side'],
+                  order['order_type'], order['price'], order['quantity'], order['size_usdt'], order['status'], order['time'])
+                 for order in orders])
+            conn.executemany('''INSERT INTO ClosedPositions 
+                (user_id, symbol, quantity, size_usdt, entry_price, exit_price, realized_pnl, close_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                [(pos['user_id'], pos['symbol'], pos['quantity'], pos['size_usdt'], pos['entry_price'],
+                  pos['exit_price'], pos['realized_pnl'], pos['close_time']) for pos in closed])
+            conn.executemany('''INSERT INTO PnlRollup
+                (user_id, symbol, day, trades, wins, losses, realized_pnl, gross_profit, gross_loss)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, symbol, day) DO UPDATE SET trades = trades + excluded.trades,
+                    wins = wins + excluded.wins, losses = losses + excluded.losses,
+                    realized_pnl = realized_pnl + excluded.realized_pnl,
+                    gross_profit = gross_profit + excluded.gross_profit, gross_loss = gross_loss + excluded.gross_loss''',
+                [key + tuple(totals) for key, totals in rollup_closed_positions(closed).items()])
+            write_lots(conn, lots)
+    except Exception:
+        # Put the rows back so the next pass retries them
+        with config_lock:
+            dirty_accounts.update(user_id for user_id, _ in accounts)
+        with orders_lock:
+            for order in orders:
+                dirty_orders.setdefault(order['order_id'], order)
+            restore_dirty_lots(lots)
+        raise
+    # Positions appended while we were writing stay queued for the next pass
+    with orders_lock:
+        del closed_positions[:len(closed)]
+    return len(accounts) + len(orders) + len(closed) + len(lots)
+
+def rollup_closed_positions(closed):
+    rollup = {}
+    for pos in closed:
+        pnl = pos['realized_pnl'] or 0.0
+        totals = rollup.setdefault((pos['user_id'], pos['symbol'], (pos['close_time'] or '')[:10]), [0, 0, 0, 0.0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += pnl > 0
+        totals[2] += pnl < 0
+        totals[3] += pnl
+        totals[4] += max(pnl, 0.0)
+        totals[5] += min(pnl, 0.0)
+    return rollup
+
 def db_updater(db_file="trading_data.db"):
     update_count = 0
+    conn = None
     while not shutdown_event.is_set():
+        db_flush_event.wait(CONFIG["db_update_interval"])
+        db_flush_event.clear()
+        if not owns_background():
+            continue
         try:
-            with get_db_connection(db_file) as conn:
-                cursor = conn.cursor()
-                with data_lock:
-                    for user_id, config in current_config.items():
-                        cursor.execute('''INSERT OR REPLACE INTO Config 
-                            (user_id, api_key, api_secret, status, available_fund, live_pnl, multiplier, leverage)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                            (user_id, config['api_key'], config['api_secret'], config['status'],
-                             config['available_fund'], config['live_pnl'], config.get('multiplier', 1.0),
-                             config.get('leverage', 1)))
-                    for order in pending_orders:
-                        cursor.execute('''INSERT OR REPLACE INTO Orders 
-                            (order_id, user_id, symbol, side, order_type, price, quantity, size_usdt, status, time)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                            (order['order_id'], order['user_id'], order['symbol'], order['side'],
-                             order['order_type'], order['price'], order['quantity'], order['size_usdt'], order['status'], order['time']))
-                    for pos in closed_positions:
-                        cursor.execute('''INSERT INTO ClosedPositions 
-                            (user_id, symbol, quantity, size_usdt, entry_price, exit_price, realized_pnl, close_time)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                            (pos['user_id'], pos['symbol'], pos['quantity'], pos['size_usdt'], pos['entry_price'],
-                             pos['exit_price'], pos['realized_pnl'], pos['close_time']))
-                    closed_positions.clear()
-                conn.commit()
+            if conn is None:
+                conn = get_db_connection(db_file)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            started = time.perf_counter()
+            written = flush_pending_writes(conn)
+            if written:
+                observe("tv2_db_flush_seconds", time.perf_counter() - started)
+                increment("tv2_db_flush_rows_total", written)
                 update_count += 1
                 if update_count % 300 == 0:
                     log_message('INFO', "Database updated successfully")
         except Exception as e:
+            increment("tv2_db_flush_errors_total")
             log_message('ERROR', f"Error updating database: {e}")
-        threading.Event().wait(CONFIG["db_update_interval"])
+            if conn is not None:
+                conn.close()
+                conn = None
+    if conn is not None and owns_background():
+        try:
+            flush_pending_writes(conn)
+        except Exception as e:
+            log_message('ERROR', f"Error flushing database on shutdown: {e}")
+        conn.close()
+
+def load_trade_cursors(db_file="trading_data.db"):
+    with get_db_connection(db_file) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, symbol, last_trade_id FROM TradeCursors")
+        for row in cursor.fetchall():
+            trade_cursors[(row[0], row[1])] = row[2]
+            traded_symbols.setdefault(row[0], set()).add(row[1])
+        cursor.execute("SELECT DISTINCT user_id, symbol FROM Orders")
+        for row in cursor.fetchall():
+            traded_symbols.setdefault(row[0], set()).add(row[1])
+    log_message('INFO', f"Loaded {len(trade_cursors)} trade cursors")
+
+def save_trade_cursor(user_id, symbol, last_trade_id):
+    trade_cursors[(user_id, symbol)] = last_trade_id
+    # The lots these trades consumed are written with the cursor, so a new owner never sees one without the other
+    with orders_lock:
+        lots = take_dirty_lots((user_id, symbol))
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT OR REPLACE INTO TradeCursors (user_id, symbol, last_trade_id) VALUES (?, ?, ?)",
+                           (user_id, symbol, last_trade_id))
+            write_lots(conn, lots)
+            conn.commit()
+    except Exception:
+        with orders_lock:
+            restore_dirty_lots(lots)
+        raise
+
+# Without a cursor the first page would reach back to exits from before any lot we hold and match
+# them against fresh entries, so it starts at the earliest open lot's order time instead
+def first_fetch_start(user_id, symbol):
+    with orders_lock:
+        lots = lot_ledger.get((user_id, symbol))
+        placed = lots[0].get('time') if lots else None
+    if not placed:
+        return None
+    return int(datetime.strptime(placed, "%Y-%m-%d %H:%M:%S").timestamp() * 1000) - 1000
+
+def fetch_new_trades(client, user_id, symbol):
+    trades = []
+    last_trade_id = trade_cursors.get((user_id, symbol))
+    start_time = first_fetch_start(user_id, symbol) if last_trade_id is None else None
+    while True:
+        params = {"symbol": symbol, "limit": 1000}
+        if last_trade_id is not None:
+            params["fromId"] = last_trade_id + 1
+        elif start_time is not None:
+            params["startTime"] = start_time
+        batch = api_call(client, "futures_account_trades", priority=PRIORITY_BACKGROUND, user_id=user_id, defer=True, **params)
+        trades.extend(batch)
+        if len(batch) < 1000:
+            return trades
+        last_trade_id = batch[-1]['id']
 
 @retry(
     stop=stop_after_attempt(CONFIG["max_retries"]),
     wait=wait_exponential(multiplier=1, min=1, max=CONFIG["max_backoff"]),
     retry=retry_if_exception_type((requests.exceptions.RequestException, BinanceAPIException))
 )
+def sync_account_trades(user_id, config):
+    client = get_client(user_id, config)
+    symbols = set(traded_symbols.get(user_id, ())) | set(get_account_positions(user_id, config, priority=PRIORITY_BACKGROUND))
+
+    for symbol in sorted(symbols):
+        trades = fetch_new_trades(client, user_id, symbol)
+        for trade in trades:
+            side = trade['side']
+            quantity = float(trade['qty'])
+            price = float(trade['price'])
+            realized_pnl = float(trade['realizedPnl'])
+            trade_time = datetime.fromtimestamp(trade['time'] / 1000).strftime("%Y-%m-%d %H:%M:%S")
+            order_id = str(trade['orderId'])
+
+            with orders_lock:
+                matched, entry_price = match_exit(user_id, symbol, side, quantity)
+                # The part of this order that closed earlier lots is not a new entry
+                own_lot = open_lots.get(order_id)
+                if own_lot is not None and matched:
+                    release_lot(own_lot, matched)
+                own_order = pending_orders.get(order_id)
+                if own_order is not None and own_order.get('reduce_only'):
+                    pending_orders.pop(order_id, None)
+            if not matched:
+                continue
+
+            if entry_price is None:
+                entry_price = get_mark_price(symbol)
+                log_message('INFO', f"Fetched current price {entry_price} for {symbol} as entry price was invalid")
+            size_usdt = matched * entry_price
+            closed = {
+                "user_id": user_id,
+                "symbol": symbol,
+                "quantity": matched,
+                "size_usdt": size_usdt,
+                "entry_price": entry_price,
+                "exit_price": price,
+                "realized_pnl": realized_pnl,
+                "close_time": trade_time
+            }
+            with orders_lock:
+                closed_positions.append(closed)
+            increment("tv2_positions_closed_total")
+            publish_event("position_closed", closed)
+            log_message('INFO', f"Closed {matched} of position for {user_id} on {symbol} at weighted entry {entry_price}: Realized PNL {realized_pnl}")
+        if trades:
+            # Advance per symbol so a retry of this account resumes after the trades already handled
+            save_trade_cursor(user_id, symbol, max(trade['id'] for trade in trades))
+
 def sync_closed_positions():
     failed_users = []
-    with data_lock:
-        for user_id, config in current_config.items():
-            try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-                trades = client.futures_account_trades()
-                current_positions_info = client.futures_position_information()
-                position_dict = {pos['symbol']: float(pos['positionAmt']) for pos in current_positions_info}
-                
-                for trade in trades:
-                    symbol = trade['symbol']
-                    side = trade['side']
-                    quantity = float(trade['qty'])
-                    price = float(trade['price'])
-                    realized_pnl = float(trade['realizedPnl'])
-                    trade_time = datetime.fromtimestamp(trade['time'] / 1000).strftime("%Y-%m-%d %H:%M:%S")
-                    
-                    matching_order = next((order for order in pending_orders if order['user_id'] == user_id and order['symbol'] == symbol and order['side'] != side and order['status'] == 'FILLED'), None)
-                    if matching_order:
-                        current_position_amt = position_dict.get(symbol, 0.0)
-                        if current_position_amt == 0 and realized_pnl != 0:
-                            entry_price = matching_order['price']
-                            if entry_price is None or entry_price == 0:
-                                entry_price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                                log_message('INFO', f"Fetched current price {entry_price} for {symbol} as entry price was invalid")
-                            size_usdt = quantity * entry_price
-                            with get_db_connection() as conn:
-                                cursor = conn.cursor()
-                                cursor.execute("UPDATE Orders SET quantity = ?, size_usdt = ?, price = ? WHERE order_id = ?",
-                                               (quantity, size_usdt, entry_price, matching_order['order_id']))
-                                conn.commit()
-                                log_message('INFO', f"Updated order {matching_order['order_id']} with quantity {quantity}, size_usdt {size_usdt}, price {entry_price}")
-                            closed_positions.append({
-                                "user_id": user_id,
-                                "symbol": symbol,
-                                "quantity": quantity,
-                                "size_usdt": size_usdt,
-                                "entry_price": entry_price,
-                                "exit_price": price,
-                                "realized_pnl": realized_pnl,
-                                "close_time": trade_time
-                            })
-                            pending_orders.remove(matching_order)
-                            log_message('INFO', f"Closed position for {user_id} on {symbol}: Realized PNL {realized_pnl}")
-            except Exception as e:
-                failed_users.append(user_id)
-                log_message('ERROR', f"Error syncing closed positions for {user_id}: {str(e)}. Check internet connectivity or Binance API status.")
+    started = time.perf_counter()
+    for user_id, config in config_snapshot().items():
+        try:
+            sync_account_trades(user_id, config)
+        except Exception as e:
+            failed_users.append(user_id)
+            increment("tv2_sync_account_failures_total")
+            log_message('ERROR', f"Error syncing closed positions for {user_id}: {str(e)}. Check internet connectivity or Binance API status.")
+    observe("tv2_sync_cycle_seconds", time.perf_counter() - started)
     if failed_users:
         log_message('ERROR', f"Failed to sync closed positions for users: {', '.join(failed_users)}")
 
 def sync_closed_positions_periodically():
     while not shutdown_event.is_set():
-        sync_closed_positions()
-        threading.Event().wait(60)
+        if owns_background():
+            with sync_lock:
+                sync_closed_positions()
+        # Set by the owner when another worker's /sync_closed_positions is waiting on it
+        sync_event.wait(60)
+        sync_event.clear()
+
+def validate_webhook_data(data, action, market):
+    try:
+        if action == "trade":
+            symbol = data.get('symbol', '').upper()
+            side = data.get('side', '').lower()
+            size = float(data.get('size', 0))
+            return bool(symbol) and side in ['buy', 'sell'] and 0 < size <= 100 and market in ['futures', 'spot']
+        elif action == "close":
+            symbol = data.get('symbol', '').upper()
+            percentage = float(data.get('percentage', 100))
+            return bool(symbol) and 0 < percentage <= 100 and market in ['futures', 'spot']
+        elif action == "close_all":
+            return market in ['futures', 'spot']
+    except (TypeError, ValueError):
+        return False
+    # The action becomes a metrics label, so only the known ones get past this point
+    return False
+
+# Reduce-only orders go out in exchange-sized batches; each spec comes back paired with
+# its order response, or with a {"code", "msg"} error as Binance reports per batch entry
+def submit_reduce_only_orders(client, user_id, orders):
+    submitted = []
+    size = CONFIG["batch_order_size"]
+    for start in range(0, len(orders), size):
+        chunk = orders[start:start + size]
+        try:
+            if len(chunk) == 1:
+                responses = [api_call(client, "futures_create_order", priority=PRIORITY_ORDER, user_id=user_id,
+                                      symbol=chunk[0]['symbol'], side=chunk[0]['side'], type="MARKET",
+                                      quantity=chunk[0]['quantity'], reduceOnly=True)]
+            else:
+                responses = api_call(client, "futures_place_batch_order", priority=PRIORITY_ORDER, user_id=user_id,
+                                     batchOrders=[{"symbol": spec['symbol'], "side": spec['side'], "type": "MARKET",
+                                                   "quantity": f"{spec['quantity']:.{spec['precision']}f}",
+                                                   "reduceOnly": "true"} for spec in chunk])
+        except Exception as e:
+            responses = [{"msg": str(e)}] * len(chunk)
+        submitted.extend(zip(chunk, responses))
+    return submitted
+
+def process_account_signal(user_id, config, data, action, market, price=None, sized=None):
+    result = {"user_id": user_id, "status": "skipped", "orders": []}
+    new_orders = []
+    try:
+        client = get_client(user_id, config)
+
+        if action == "trade":
+            symbol = data.get('symbol', '').upper()
+            side = data.get('side', '').lower()
+            size = float(data.get('size', 0))
+
+            with timed("tv2_webhook_stage_seconds", stage="symbol_info"):
+                step = get_quantity_step(client, symbol, market)
+            if step is None:
+                log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
+                result.update(status="error", reason="missing LOT_SIZE filter")
+                return result, new_orders
+
+            # Accounts with a fresh balance snapshot arrive already sized by the batch pass in run_signal
+            if sized is None:
+                with timed("tv2_webhook_stage_seconds", stage="balance"):
+                    if market == "futures":
+                        balance = get_available_balance(user_id, config)
+                    else:
+                        balance = float(next(b['free'] for b in api_call(client, "get_account", priority=PRIORITY_ORDER, user_id=user_id)['balances'] if b['asset'] == 'USDT'))
+                with timed("tv2_webhook_stage_seconds", stage="rounding"):
+                    sized = (balance,) + size_trade_batch([(balance, config['multiplier'], config['leverage'])], size, price, step, market == "futures")[0]
+            balance, notional_value, quantity = sized
+
+            if quantity is None:
+                log_message('INFO', f"Skipping order for {user_id}: Notional value {notional_value} is below minimum 5 USDT. Balance: {balance}, Multiplier: {config['multiplier']}, Leverage: {config['leverage']}, Size: {size}, Price: {price}")
+                result["reason"] = "below minimum notional"
+                return result, new_orders
+
+            log_message('INFO', f"Calculated quantity for {user_id} on {symbol}: {quantity} (stepSize: {step[0]}, precision: {step[3]})", chatty=True)
+
+            if quantity == 0:
+                log_message('INFO', f"Quantity for {user_id} on {symbol} is 0 after rounding")
+                result["reason"] = "quantity is 0 after rounding"
+                return result, new_orders
+
+            order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            size_usdt = quantity * price
+            with timed("tv2_webhook_stage_seconds", stage="submit"):
+                if market == "futures":
+                    order = api_call(
+                        client, "futures_create_order",
+                        priority=PRIORITY_ORDER,
+                        user_id=user_id,
+                        symbol=symbol,
+                        side=side.upper(),
+                        type="MARKET",
+                        quantity=quantity
+                    )
+                else:
+                    order = api_call(client, "order_market_buy" if side == "buy" else "order_market_sell",
+                                     priority=PRIORITY_ORDER, user_id=user_id, symbol=symbol, quantity=quantity)
+
+            order_id = str(order['orderId'])
+            new_orders.append({
+                "order_id": order_id,
+                "user_id": user_id,
+                "symbol": symbol,
+                "side": side.upper(),
+                "order_type": "MARKET",
+                "price": price,
+                "quantity": quantity,
+                "size_usdt": size_usdt,
+                "status": "FILLED",
+                "time": order_time
+            })
+            log_message('INFO', f"Placed {market} {side} order for {user_id} on {symbol}: {quantity} units (Size USDT: {size_usdt})")
+
+        elif action == "close":
+            symbol = data.get('symbol', '').upper()
+            percentage = float(data.get('percentage', 100))
+
+            with timed("tv2_webhook_stage_seconds", stage="positions"):
+                open_positions = get_account_positions(user_id, config, force=CONFIG["position_force_refresh"])
+            position = open_positions.get(symbol)
+            if not position:
+                open_symbols = list(open_positions)
+                log_message('INFO', f"No open position for {user_id} on {symbol} to close. Open positions: {open_symbols}")
+                result["reason"] = "no open position"
+                return result, new_orders
+
+            position_amt = position[0]
+            side_to_close = "SELL" if position_amt > 0 else "BUY"
+            quantity_to_close = abs(position_amt) * (percentage / 100)
+
+            with timed("tv2_webhook_stage_seconds", stage="symbol_info"):
+                step = get_quantity_step(client, symbol, "futures")
+            if step is None:
+                log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
+                result.update(status="error", reason="missing LOT_SIZE filter")
+                return result, new_orders
+
+            with timed("tv2_webhook_stage_seconds", stage="rounding"):
+                quantity_to_close = quantize_quantity(quantity_to_close, step)
+            log_message('INFO', f"Calculated quantity to close for {user_id} on {symbol}: {quantity_to_close} (stepSize: {step[0]}, precision: {step[3]})", chatty=True)
+
+            if quantity_to_close == 0:
+                log_message('INFO', f"Quantity to close for {user_id} on {symbol} is 0 after rounding")
+                result["reason"] = "quantity is 0 after rounding"
+                return result, new_orders
+
+            order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            notional_value = quantity_to_close * price
+            log_message('INFO', f"Notional value of closing order for {user_id} on {symbol}: {notional_value} USDT", chatty=True)
+
+            with timed("tv2_webhook_stage_seconds", stage="submit"):
+                order = api_call(
+                    client, "futures_create_order",
+                    priority=PRIORITY_ORDER,
+                    user_id=user_id,
+                    symbol=symbol,
+                    side=side_to_close,
+                    type="MARKET",
+                    quantity=quantity_to_close,
+                    reduceOnly=True
+                )
+
+            order_id = str(order['orderId'])
+            size_usdt = quantity_to_close * price
+            new_orders.append({
+                "order_id": order_id,
+                "user_id": user_id,
+                "symbol": symbol,
+                "side": side_to_close,
+                "order_type": "MARKET",
+                "price": price,
+                "quantity": quantity_to_close,
+                "size_usdt": size_usdt,
+                "status": "FILLED",
+                "time": order_time,
+                "reduce_only": True
+            })
+            log_message('INFO', f"Closed {percentage}% of position for {user_id} on {symbol}: {quantity_to_close} units via {side_to_close} order")
+
+        elif action == "close_all":
+            with timed("tv2_webhook_stage_seconds", stage="positions"):
+                open_positions = get_account_positions(user_id, config, force=CONFIG["position_force_refresh"])
+
+            if not open_positions:
+                log_message('INFO', f"No open positions to close for {user_id}")
+                result["reason"] = "no open positions"
+                return result, new_orders
+
+            closing = []
+            for symbol, position in open_positions.items():
+                position_amt = position[0]
+                side_to_close = "SELL" if position_amt > 0 else "BUY"
+                quantity_to_close = abs(position_amt)
+
+                with timed("tv2_webhook_stage_seconds", stage="symbol_info"):
+                    step = get_quantity_step(client, symbol, "futures")
+                if step is None:
+                    log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
+                    continue
+
+                with timed("tv2_webhook_stage_seconds", stage="rounding"):
+                    quantity_to_close = quantize_quantity(quantity_to_close, step)
+                log_message('INFO', f"Calculated quantity to close for {user_id} on {symbol}: {quantity_to_close} (stepSize: {step[0]}, precision: {step[3]})", chatty=True)
+
+                if quantity_to_close == 0:
+                    log_message('INFO', f"Quantity to close for {user_id} on {symbol} is 0 after rounding")
+                    continue
+
+                # The price only sizes the record, so a missing quote must not stop the account from flattening
+                with timed("tv2_webhook_stage_seconds", stage="price"):
+                    try:
+                        price = get_mark_price(symbol)
+                    except Exception as e:
+                        price = position[2]
+                        log_message('ERROR', f"{e}, using the position's mark price {price} for {user_id} on {symbol}")
+                log_message('INFO', f"Notional value of closing order for {user_id} on {symbol}: {quantity_to_close * price} USDT", chatty=True)
+                closing.append({"symbol": symbol, "side": side_to_close, "quantity": quantity_to_close,
+                                "precision": step[3], "price": price})
+
+            order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with timed("tv2_webhook_stage_seconds", stage="submit"):
+                submitted = submit_reduce_only_orders(client, user_id, closing)
+
+            for spec, response in submitted:
+                symbol = spec['symbol']
+                if 'orderId' not in response:
+                    log_message('ERROR', f"Failed to close position for {user_id} on {symbol}: {response.get('msg', response)}")
+                    result.setdefault("failed", []).append({"symbol": symbol, "error": response.get('msg', str(response))})
+                    continue
+                order_id = str(response['orderId'])
+                size_usdt = spec['quantity'] * spec['price']
+                new_orders.append({
+                    "order_id": order_id,
+                    "user_id": user_id,
+                    "symbol": symbol,
+                    "side": spec['side'],
+                    "order_type": "MARKET",
+                    "price": spec['price'],
+                    "quantity": spec['quantity'],
+                    "size_usdt": size_usdt,
+                    "status": "FILLED",
+                    "time": order_time,
+                    "reduce_only": True
+                })
+                log_message('INFO', f"Closed all position for {user_id} on {symbol}: {spec['quantity']} units via {spec['side']} order")
+            if result.get("failed") and not new_orders:
+                result.update(status="error", reason="all close orders failed")
+                return result, new_orders
+
+    except Exception as e:
+        log_message('ERROR', f"Error processing webhook for {user_id}: {e}")
+        result.update(status="error", reason=str(e))
+        return result, new_orders
+
+    if new_orders:
+        result.update(status="placed", orders=[order['order_id'] for order in new_orders])
+    return result, new_orders
+
+def run_account_signal(user_id, config, data, action, market, price=None, sized=None):
+    with timed("tv2_webhook_account_seconds", action=action):
+        result, new_orders = process_account_signal(user_id, config, data, action, market, price, sized)
+    # Recorded per account, not after the whole fan-out: a sync pass that sees the fill before its lot
+    # exists would match a reversal against the opposite lots and then add the lot at full size
+    if new_orders:
+        record_orders(new_orders)
+    increment("tv2_webhook_account_results_total", action=action, status=result['status'])
+    return result
+
+def size_fresh_accounts(accounts, data, price):
+    filters = get_symbol_filters(data.get('symbol', '').upper())
+    if filters is None or price is None:
+        return {}
+    step = filters['step']
+    now = time.time()
+    fresh = []
+    for user_id, config in accounts:
+        snapshot = balance_snapshots.get(user_id)
+        if snapshot is not None and now - snapshot['updated_at'] <= CONFIG["balance_max_staleness"]:
+            fresh.append((user_id, snapshot['available_fund'], config))
+    sized = size_trade_batch([(balance, config['multiplier'], config['leverage']) for _, balance, config in fresh],
+                             float(data.get('size', 0)), price, step)
+    return {user_id: (balance,) + result for (user_id, balance, _), result in zip(fresh, sized)}
+
+def dispatch_signal(accounts, data, action, market, price=None, sizing=None):
+    sizing = sizing or {}
+    if CONFIG["webhook_dispatch_mode"] == "parallel" and len(accounts) > 1:
+        futures = [order_executor.submit(run_account_signal, user_id, config, data, action, market, price, sizing.get(user_id))
+                   for user_id, config in accounts]
+        outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [run_account_signal(user_id, config, data, action, market, price, sizing.get(user_id))
+                    for user_id, config in accounts]
+    return outcomes
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -267,305 +1475,474 @@ def webhook():
     action = data.get('action', 'trade').lower()
     market = data.get('market', 'futures').lower()
 
-    with data_lock:
-        for user_id, config in current_config.items():
-            if not config['status']:
-                log_message('INFO', f"Skipping user {user_id} (status is off)")
-                continue
-            try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-
-                if action == "trade":
-                    symbol = data.get('symbol', '').upper()
-                    side = data.get('side', '').lower()
-                    size = float(data.get('size', 0))
+    if not validate_webhook_data(data, action, market):
+        log_message('ERROR', f"Invalid webhook data for {action}: {data}")
+        return jsonify({"error": "Invalid data"}), 400
+
+    if action in ["trade", "close"] and market == "futures":
+        symbol = data.get('symbol', '').upper()
+        if get_symbol_filters(symbol) is None:
+            if not exchange_info_cache:
+                return jsonify({"error": "Exchange info unavailable"}), 503
+            log_message('ERROR', f"Unknown futures symbol in webhook: {symbol}")
+            return jsonify({"error": f"Unknown symbol {symbol}"}), 400
+
+    job = build_job(data, action, market)
+    key = idempotency_key(data, action, market)
+    if key is not None:
+        original = claim_idempotency_key(key, job['job_id'])
+        if original is not None:
+            return replay_webhook(key, original)
+
+    # Only the background owner may trade, so other workers always hand the signal over as a shared job
+    if CONFIG["serve_mode"] == "production":
+        response = submit_shared_job(job)
+        if response[1] != 202 and key is not None:
+            release_idempotency_key(key, job['job_id'])
+        return response
+
+    if CONFIG["webhook_intake_mode"] != "async":
+        body, status_code = execute_signal(data, action, market)
+        if key is not None:
+            record_idempotent_result(job['job_id'], status_code, body)
+        return jsonify(body), status_code
+
+    track_job(job)
+    try:
+        webhook_queue.put_nowait(job['job_id'])
+    except queue.Full:
+        with jobs_lock:
+            webhook_jobs.pop(job['job_id'], None)
+        if key is not None:
+            release_idempotency_key(key, job['job_id'])
+        log_message('ERROR', f"Webhook queue is full ({webhook_queue.maxsize} jobs), rejecting signal: {data}")
+        return jsonify({"error": "Webhook queue is full, retry later"}), 503, {"Retry-After": "1"}
+    return jsonify({"message": "Webhook accepted", "job_id": job['job_id']}), 202
+
+# Retried alerts are recognised by their alert_id; the first delivery claims the key and later ones get
+# its outcome back. Matching identical payloads within idempotency_window seconds is opt-in (0 = off):
+# it also catches senders without an alert_id, but swallows legitimate repeats such as scale-in steps
+def idempotency_key(data, action, market):
+    alert_id = data.get('alert_id')
+    if alert_id not in (None, ''):
+        return f"alert:{alert_id}"
+    if not CONFIG["idempotency_window"]:
+        return None
+    payload = json.dumps({k: v for k, v in data.items() if k != 'token'}, sort_keys=True, default=str)
+    return f"payload:{hashlib.sha256(f'{action}:{market}:{payload}'.encode()).hexdigest()}"
+
+def claim_idempotency_key(key, job_id):
+    now = time.time()
+    with idempotency_lock:
+        original = idempotency_cache.get(key)
+        if original is not None:
+            if original['expires_at'] > now:
+                idempotency_cache.move_to_end(key)
+                return original
+            del idempotency_cache[key]
+    ttl = CONFIG["idempotency_ttl"] if key.startswith("alert:") else CONFIG["idempotency_window"]
+    # The upsert only takes over an expired key, so concurrent deliveries (from any worker) race on one row
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM WebhookKeys WHERE expires_at <= ?", (now,))
+        claimed = conn.execute("""INSERT INTO WebhookKeys (key, job_id, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET job_id = excluded.job_id, expires_at = excluded.expires_at,
+                status_code = NULL, result = NULL
+            WHERE WebhookKeys.expires_at <= ?
+            RETURNING job_id""", (key, job_id, now + ttl, now)).fetchone()
+        if claimed is not None:
+            return None
+        row = conn.execute("SELECT job_id, expires_at, status_code, result FROM WebhookKeys WHERE key = ?", (key,)).fetchone()
+    original = {"job_id": row['job_id'], "expires_at": row['expires_at'], "status_code": row['status_code'],
+                "result": json.loads(row['result']) if row['result'] else None}
+    # Only finished outcomes are cached, an in-flight original has to be looked up again next time
+    if original['result'] is not None:
+        with idempotency_lock:
+            idempotency_cache[key] = original
+            while len(idempotency_cache) > CONFIG["idempotency_cache_size"]:
+                idempotency_cache.popitem(last=False)
+    return original
+
+def release_idempotency_key(key, job_id):
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM WebhookKeys WHERE key = ? AND job_id = ?", (key, job_id))
 
-                    if not symbol or side not in ['buy', 'sell'] or size <= 0 or size > 100 or market not in ['futures', 'spot']:
-                        log_message('ERROR', f"Invalid webhook data for trade: {data}")
-                        return jsonify({"error": "Invalid data"}), 400
+# In development the queue lives in memory, so a key still waiting for its outcome at startup belongs
+# to a job that will never run; dropping it lets the alert's retry through
+def release_unfinished_idempotency_keys(db_file="trading_data.db"):
+    with get_db_connection(db_file) as conn:
+        released = conn.execute("DELETE FROM WebhookKeys WHERE result IS NULL").rowcount
+    if released:
+        log_message('INFO', f"Released {released} idempotency keys of webhook jobs lost in the last shutdown")
 
-                    if market == "futures":
-                        balance = float(client.futures_account()['availableBalance'])
-                    else:
-                        asset = symbol.replace('USDT', '') if 'USDT' in symbol else 'BTC'
-                        balance = float(next(b['free'] for b in client.get_account()['balances'] if b['asset'] == 'USDT'))
-                    # Retry fetching price to ensure it's valid
-                    price = None
-                    for attempt in range(CONFIG["max_retries"]):
-                        try:
-                            price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                            if price > 0:
-                                break
-                        except Exception as e:
-                            log_message('ERROR', f"Failed to fetch price for {symbol} (attempt {attempt + 1}/{CONFIG['max_retries']}): {e}")
-                            if attempt == CONFIG["max_retries"] - 1:
-                                raise Exception(f"Failed to fetch price for {symbol} after {CONFIG['max_retries']} attempts")
-                            threading.Event().wait(1)
-
-                    notional = balance * (size / 100) * config['multiplier']
-                    quantity = notional / price
-                    if market == "futures":
-                        quantity *= config['leverage']
-                        notional_value = quantity * price
-                        if notional_value < 5:
-                            log_message('INFO', f"Skipping order for {user_id}: Notional value {notional_value} is below minimum 5 USDT. Balance: {balance}, Multiplier: {config['multiplier']}, Leverage: {config['leverage']}, Size: {size}, Price: {price}")
-                            continue
-
-                    info = client.get_symbol_info(symbol)
-                    step_size = None
-                    quantity_precision = info.get('quantityPrecision', 0)
-                    for filt in info['filters']:
-                        if filt['filterType'] == 'LOT_SIZE':
-                            step_size = float(filt['stepSize'])
-                            break
-                    if step_size is None:
-                        log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
-                        continue
-
-                    quantity = round_quantity(quantity, step_size, quantity_precision)
-                    log_message('INFO', f"Calculated quantity for {user_id} on {symbol}: {quantity} (stepSize: {step_size}, precision: {quantity_precision})")
-
-                    if quantity == 0:
-                        log_message('INFO', f"Quantity for {user_id} on {symbol} is 0 after rounding")
-                        continue
-
-                    order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    size_usdt = quantity * price
-                    if market == "futures":
-                        order = client.futures_create_order(
-                            symbol=symbol,
-                            side=side.upper(),
-                            type="MARKET",
-                            quantity=quantity
-                        )
-                    else:
-                        order = client.order_market_buy(symbol=symbol, quantity=quantity) if side == "buy" else client.order_market_sell(symbol=symbol, quantity=quantity)
-
-                    order_id = str(order['orderId'])
-                    pending_orders.append({
-                        "order_id": order_id,
-                        "user_id": user_id,
-                        "symbol": symbol,
-                        "side": side.upper(),
-                        "order_type": "MARKET",
-                        "price": price,
-                        "quantity": quantity,
-                        "size_usdt": size_usdt,
-                        "status": "FILLED",
-                        "time": order_time
-                    })
-                    log_message('INFO', f"Placed {market} {side} order for {user_id} on {symbol}: {quantity} units (Size USDT: {size_usdt})")
-
-                elif action == "close":
-                    symbol = data.get('symbol', '').upper()
-                    percentage = float(data.get('percentage', 100))
-
-                    if not symbol or percentage <= 0 or percentage > 100 or market not in ['futures', 'spot']:
-                        log_message('ERROR', f"Invalid webhook data for close: {data}")
-                        return jsonify({"error": "Invalid data"}), 400
-
-                    positions = client.futures_position_information()
-                    position = next((pos for pos in positions if pos['symbol'] == symbol and float(pos['positionAmt']) != 0), None)
-                    if not position:
-                        open_symbols = [pos['symbol'] for pos in positions if float(pos['positionAmt']) != 0]
-                        log_message('INFO', f"No open position for {user_id} on {symbol} to close. Open positions: {open_symbols}")
-                        continue
-
-                    position_amt = float(position['positionAmt'])
-                    side_to_close = "SELL" if position_amt > 0 else "BUY"
-                    quantity_to_close = abs(position_amt) * (percentage / 100)
-
-                    info = client.get_symbol_info(symbol)
-                    step_size = None
-                    quantity_precision = info.get('quantityPrecision', 0)
-                    for filt in info['filters']:
-                        if filt['filterType'] == 'LOT_SIZE':
-                            step_size = float(filt['stepSize'])
-                            break
-                    if step_size is None:
-                        log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
-                        continue
-
-                    quantity_to_close = round_quantity(quantity_to_close, step_size, quantity_precision)
-                    log_message('INFO', f"Calculated quantity to close for {user_id} on {symbol}: {quantity_to_close} (stepSize: {step_size}, precision: {quantity_precision})")
-
-                    if quantity_to_close == 0:
-                        log_message('INFO', f"Quantity to close for {user_id} on {symbol} is 0 after rounding")
-                        continue
-
-                    order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                    notional_value = quantity_to_close * price
-                    log_message('INFO', f"Notional value of closing order for {user_id} on {symbol}: {notional_value} USDT")
-
-                    order = client.futures_create_order(
-                        symbol=symbol,
-                        side=side_to_close,
-                        type="MARKET",
-                        quantity=quantity_to_close,
-                        reduceOnly=True
-                    )
+def record_idempotent_result(job_id, status_code, body):
+    try:
+        with get_db_connection() as conn:
+            # A 503 means nothing reached the exchange, so the alert's retry should get to run
+            if status_code == 503:
+                conn.execute("DELETE FROM WebhookKeys WHERE job_id = ?", (job_id,))
+            else:
+                conn.execute("UPDATE WebhookKeys SET status_code = ?, result = ? WHERE job_id = ?",
+                             (status_code, json.dumps(body), job_id))
+    except Exception as e:
+        log_message('ERROR', f"Error recording idempotency result for job {job_id}: {e}")
+
+def replay_webhook(key, original):
+    increment("tv2_webhook_duplicates_total")
+    log_message('INFO', f"Duplicate webhook {key}, returning outcome of job {original['job_id']}")
+    headers = {"Idempotent-Replay": "true"}
+    if original['result'] is not None:
+        return jsonify(original['result']), original['status_code'], headers
+    return jsonify({"message": "Webhook already accepted", "job_id": original['job_id']}), 202, headers
+
+def execute_signal(data, action, market):
+    with timed("tv2_webhook_signal_seconds", action=action):
+        body, status_code = run_signal(data, action, market)
+    increment("tv2_webhook_signals_total", action=action, status=status_code)
+    return body, status_code
+
+def run_signal(data, action, market):
+    price = None
+    if action in ["trade", "close"]:
+        symbol = data.get('symbol', '').upper()
+        try:
+            with timed("tv2_webhook_stage_seconds", stage="price"):
+                price = get_signal_price(symbol, market)
+        except Exception as e:
+            log_message('ERROR', str(e))
+            return {"error": f"Price unavailable for {symbol}"}, 503
+
+    snapshot = config_snapshot()
+    results = {}
+    accounts = []
+    for user_id, config in snapshot.items():
+        if not config['status']:
+            log_message('INFO', f"Skipping user {user_id} (status is off)", chatty=True)
+            results[user_id] = {"user_id": user_id, "status": "skipped", "orders": [], "reason": "status is off"}
+            continue
+        accounts.append((user_id, config))
+    sizing = None
+    if action == "trade" and market == "futures":
+        with timed("tv2_webhook_stage_seconds", stage="rounding"):
+            sizing = size_fresh_accounts(accounts, data, price)
+    for result in dispatch_signal(accounts, data, action, market, price, sizing):
+        results[result['user_id']] = result
+    results = [results[user_id] for user_id in snapshot if user_id in results]
+    return {"message": "Webhook processed", "results": results}, 200
+
+def build_job(data, action, market):
+    return {
+        "job_id": uuid.uuid4().hex,
+        "status": "queued",
+        "action": action,
+        "market": market,
+        "data": {k: v for k, v in data.items() if k != 'token'},
+        "submitted_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "queued_at": time.time(),
+        "finished_at": None,
+        "status_code": None,
+        "result": None
+    }
+
+def track_job(job):
+    with jobs_lock:
+        webhook_jobs[job['job_id']] = job
+        while len(webhook_jobs) > CONFIG["max_tracked_jobs"]:
+            webhook_jobs.popitem(last=False)
+    return job
+
+# Trade and close signals for one symbol that arrive within coalesce_window seconds of each other
+# are held back and netted; anything else (close_all) goes straight through
+def coalesce_key(job):
+    if not CONFIG["coalesce_window"] or job['action'] not in ("trade", "close"):
+        return None
+    return job['data'].get('symbol', '').upper(), job['market']
+
+def signed_trade_size(job):
+    return float(job['data']['size']) * (1 if job['data']['side'].lower() == "buy" else -1)
+
+# Consecutive trades net to one trade of the signed size sum, consecutive closes compound into one
+# percentage of the position; a trade/close boundary is a distinct decision and stays a separate fan-out.
+# A netted trade is sized once against the balance at execution, where running the signals one by one
+# would size each against what the previous ones left, so it is larger than the sequential fills would
+# add up to. A run therefore never nets past the 100% a single signal may ask for; the job that would
+# push it over starts a new run.
+def coalesce_signals(jobs):
+    runs = []
+    for job in jobs:
+        if runs and runs[-1][0] == job['action'] and (
+                job['action'] != "trade" or abs(runs[-1][2] + signed_trade_size(job)) <= 100):
+            runs[-1][1].append(job)
+        else:
+            runs.append([job['action'], [job], 0.0])
+        if job['action'] == "trade":
+            runs[-1][2] += signed_trade_size(job)
+    signals = []
+    for action, members, net in runs:
+        data = dict(members[0]['data'])
+        if action == "trade" and len(members) > 1:
+            if abs(net) < 1e-9:
+                data = None
+            else:
+                data.update(side="buy" if net > 0 else "sell", size=abs(net))
+        elif action == "close" and len(members) > 1:
+            remaining = 1.0
+            for job in members:
+                remaining *= 1 - float(job['data'].get('percentage', 100)) / 100
+            data['percentage'] = (1 - remaining) * 100
+        signals.append((action, members[0]['market'], data, members))
+    return signals
+
+def execute_jobs(jobs):
+    outcomes = []
+    for action, market, data, members in coalesce_signals(jobs):
+        if len(members) > 1:
+            increment("tv2_webhook_coalesced_total", len(members) - 1)
+            log_message('INFO', f"Coalesced {len(members)} {action} signals for {members[0]['data'].get('symbol')}: {'netted out' if data is None else data}")
+        try:
+            if data is None:
+                body, status_code = {"message": "Signals netted out", "results": []}, 200
+            else:
+                body, status_code = execute_signal(data, action, market)
+        except Exception as e:
+            log_message('ERROR', f"Error executing webhook job {members[0]['job_id']}: {e}")
+            body, status_code = {"error": str(e)}, 500
+        if len(members) > 1:
+            body = dict(body, coalesced=[job['job_id'] for job in members])
+        outcomes.extend((job, body, status_code) for job in members)
+    return outcomes
+
+def webhook_dispatcher():
+    held = OrderedDict()
+    while not shutdown_event.is_set():
+        timeout = 1
+        if held:
+            timeout = max(min(group[0]['queued_at'] for group in held.values()) + CONFIG["coalesce_window"] - time.time(), 0)
+        try:
+            job_id = webhook_queue.get(timeout=timeout)
+        except queue.Empty:
+            job_id = None
+        ready = []
+        if job_id is not None:
+            with jobs_lock:
+                job = webhook_jobs.get(job_id)
+            if job is None:
+                webhook_queue.task_done()
+                continue
+            key = coalesce_key(job)
+            if key is None:
+                # Held signals were queued first, so they go out before this one
+                ready = list(held.values()) + [[job]]
+                held.clear()
+            else:
+                held.setdefault(key, []).append(job)
+        now = time.time()
+        due = [key for key, group in held.items() if group[0]['queued_at'] + CONFIG["coalesce_window"] <= now]
+        ready = [held.pop(key) for key in due] + ready
+        for group in ready:
+            for job in group:
+                job['status'] = "running"
+                observe("tv2_webhook_queue_wait_seconds", time.time() - job['queued_at'])
+            for job, body, status_code in execute_jobs(group):
+                job.update(status="done" if status_code == 200 else "failed", status_code=status_code, result=body,
+                           finished_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                record_idempotent_result(job['job_id'], status_code, body)
+                webhook_queue.task_done()
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    if CONFIG["serve_mode"] == "production":
+        job = load_shared_job(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(job)
+    with jobs_lock:
+        job = webhook_jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found"}), 404
+        job = dict(job)
+    job['queue_depth'] = webhook_queue.qsize()
+    return jsonify(job)
+
+def backfill_price(symbol, prices, client=None, user_id=None):
+    if symbol not in prices:
+        try:
+            prices[symbol] = get_mark_price(symbol)
+        except Exception:
+            if client is None:
+                raise
+            prices[symbol] = float(api_call(client, "get_symbol_ticker", symbol=symbol, priority=PRIORITY_BACKGROUND, user_id=user_id, defer=True)['price'])
+    return prices[symbol]
+
+# Each backfill pass gets one page of rows and returns (updates, skipped, failed); rows are grouped
+# by owning account and symbol so every order is looked up once, with its own account's client
+def backfill_order_sizes(rows, prices):
+    updates, skipped, failed = [], 0, 0
+    snapshot = config_snapshot()
+    for (user_id, symbol), group in itertools.groupby(sorted(rows, key=lambda row: (row['user_id'], row['symbol'])),
+                                                      key=lambda row: (row['user_id'], row['symbol'])):
+        group = list(group)
+        config = snapshot.get(user_id)
+        if config is None:
+            log_message('WARNING', f"Skipping {len(group)} orders of unknown account {user_id}")
+            skipped += len(group)
+            continue
+        try:
+            client = get_client(user_id, config)
+            price = backfill_price(symbol, prices, client, user_id)
+        except Exception as e:
+            log_message('ERROR', f"Failed to price {symbol} for order size backfill of {user_id}: {e}")
+            failed += len(group)
+            continue
+        for order in group:
+            try:
+                binance_order = api_call(client, "futures_get_order", symbol=symbol, orderId=order['order_id'], priority=PRIORITY_BACKGROUND, user_id=user_id, defer=True)
+                executed_qty = float(binance_order.get('executedQty', 0))
+                orig_qty = float(binance_order.get('origQty', 0))
+                if order['status'] == "FILLED" and executed_qty > 0:
+                    updates.append((executed_qty, executed_qty * price, order['order_id']))
+                elif order['status'] == "NEW" and orig_qty > 0:
+                    updates.append((orig_qty, orig_qty * price, order['order_id']))
+                else:
+                    log_message('WARNING', f"No valid quantity for order {order['order_id']}, skipping size_usdt update")
+                    skipped += 1
+            except Exception as e:
+                log_message('ERROR', f"Failed to update size_usdt for order {order['order_id']}: {e}")
+                failed += 1
+    return updates, skipped, failed
+
+def backfill_closed_position_sizes(rows, prices):
+    updates, skipped, failed = [], 0, 0
+    for pos in rows:
+        if not pos['quantity']:
+            log_message('WARNING', f"No quantity for closed position {pos['id']}, skipping size_usdt update")
+            skipped += 1
+            continue
+        entry_price = pos['entry_price']
+        if not entry_price:
+            try:
+                entry_price = backfill_price(pos['symbol'], prices)
+            except Exception as e:
+                log_message('ERROR', f"Failed to update size_usdt for closed position {pos['id']}: {e}")
+                failed += 1
+                continue
+        updates.append((entry_price, pos['quantity'] * entry_price, pos['id']))
+    return updates, skipped, failed
+
+BACKFILLS = {
+    "order_sizes": ("Orders", "order_id, user_id, symbol, status",
+                    "UPDATE Orders SET quantity = ?, size_usdt = ? WHERE order_id = ?", backfill_order_sizes),
+    "closed_position_sizes": ("ClosedPositions", "id, user_id, symbol, quantity, entry_price",
+                              "UPDATE ClosedPositions SET entry_price = ?, size_usdt = ? WHERE id = ?", backfill_closed_position_sizes)
+}
 
-                    order_id = str(order['orderId'])
-                    size_usdt = quantity_to_close * price
-                    pending_orders.append({
-                        "order_id": order_id,
-                        "user_id": user_id,
-                        "symbol": symbol,
-                        "side": side_to_close,
-                        "order_type": "MARKET",
-                        "price": price,
-                        "quantity": quantity_to_close,
-                        "size_usdt": size_usdt,
-                        "status": "FILLED",
-                        "time": order_time
-                    })
-                    log_message('INFO', f"Closed {percentage}% of position for {user_id} on {symbol}: {quantity_to_close} units via {side_to_close} order")
-
-                elif action == "close_all":
-                    if market not in ['futures', 'spot']:
-                        log_message('ERROR', f"Invalid market in close_all: {data}")
-                        return jsonify({"error": "Invalid data"}), 400
-
-                    positions = client.futures_position_information()
-                    open_positions = [pos for pos in positions if float(pos['positionAmt']) != 0]
-
-                    if not open_positions:
-                        log_message('INFO', f"No open positions to close for {user_id}")
-                        continue
-
-                    for position in open_positions:
-                        symbol = position['symbol']
-                        position_amt = float(position['positionAmt'])
-                        side_to_close = "SELL" if position_amt > 0 else "BUY"
-                        quantity_to_close = abs(position_amt)
-
-                        info = client.get_symbol_info(symbol)
-                        step_size = None
-                        quantity_precision = info.get('quantityPrecision', 0)
-                        for filt in info['filters']:
-                            if filt['filterType'] == 'LOT_SIZE':
-                                step_size = float(filt['stepSize'])
-                                break
-                        if step_size is None:
-                            log_message('ERROR', f"Could not find LOT_SIZE filter for {symbol}")
-                            continue
-
-                        quantity_to_close = round_quantity(quantity_to_close, step_size, quantity_precision)
-                        log_message('INFO', f"Calculated quantity to close for {user_id} on {symbol}: {quantity_to_close} (stepSize: {step_size}, precision: {quantity_precision})")
-
-                        if quantity_to_close == 0:
-                            log_message('INFO', f"Quantity to close for {user_id} on {symbol} is 0 after rounding")
-                            continue
-
-                        order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                        notional_value = quantity_to_close * price
-                        log_message('INFO', f"Notional value of closing order for {user_id} on {symbol}: {notional_value} USDT")
-
-                        order = client.futures_create_order(
-                            symbol=symbol,
-                            side=side_to_close,
-                            type="MARKET",
-                            quantity=quantity_to_close,
-                            reduceOnly=True
-                        )
-
-                        order_id = str(order['orderId'])
-                        size_usdt = quantity_to_close * price
-                        pending_orders.append({
-                            "order_id": order_id,
-                            "user_id": user_id,
-                            "symbol": symbol,
-                            "side": side_to_close,
-                            "order_type": "MARKET",
-                            "price": price,
-                            "quantity": quantity_to_close,
-                            "size_usdt": size_usdt,
-                            "status": "FILLED",
-                            "time": order_time
-                        })
-                        log_message('INFO', f"Closed all position for {user_id} on {symbol}: {quantity_to_close} units via {side_to_close} order")
+def backfill_status(conn, kind):
+    row = conn.execute("SELECT * FROM BackfillJobs WHERE kind = ?", (kind,)).fetchone()
+    return dict(row) if row is not None else None
 
+# A job that is already queued or running is reported rather than restarted; a failed one resumes
+# from its cursor, and a finished one starts over from the first row
+def enqueue_backfill(kind):
+    table = BACKFILLS[kind][0]
+    with get_db_connection() as conn:
+        job = backfill_status(conn, kind)
+        if job is not None and job['status'] in ("queued", "running"):
+            return job
+        if job is not None and job['status'] == "failed":
+            conn.execute("UPDATE BackfillJobs SET status = 'queued', finished_at = NULL, error = NULL WHERE kind = ?", (kind,))
+        else:
+            total = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE size_usdt IS NULL OR size_usdt = 0").fetchone()[0]
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            status = "queued" if total else "done"
+            conn.execute("""INSERT OR REPLACE INTO BackfillJobs
+                (kind, status, cursor, total, processed, updated, skipped, failed, started_at, finished_at, error)
+                VALUES (?, ?, 0, ?, 0, 0, 0, 0, ?, ?, NULL)""", (kind, status, total, now, now if status == "done" else None))
+        job = backfill_status(conn, kind)
+    if job['status'] == "queued":
+        backfill_event.set()
+    return job
+
+def run_backfill(conn, kind):
+    table, columns, update_sql, process = BACKFILLS[kind]
+    prices = {}
+    job = backfill_status(conn, kind)
+    with conn:
+        conn.execute("UPDATE BackfillJobs SET status = 'running' WHERE kind = ?", (kind,))
+    log_message('INFO', f"Backfill {kind} running from row {job['cursor']} ({job['processed']}/{job['total']} done)")
+    while not shutdown_event.is_set() and owns_background():
+        rows = [dict(row) for row in conn.execute(
+            f"SELECT rowid AS rowid, {columns} FROM {table} WHERE rowid > ? AND (size_usdt IS NULL OR size_usdt = 0) ORDER BY rowid LIMIT ?",
+            (job['cursor'], CONFIG["backfill_batch_size"])).fetchall()]
+        if not rows:
+            with conn:
+                conn.execute("UPDATE BackfillJobs SET status = 'done', finished_at = ? WHERE kind = ?",
+                             (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), kind))
+            job = backfill_status(conn, kind)
+            log_message('INFO', f"Backfill {kind} finished: {job['updated']} updated, {job['skipped']} skipped, {job['failed']} failed")
+            return
+        updates, skipped, failed = process(rows, prices)
+        # The page's updates and the advanced cursor commit together, so a restart resumes exactly here
+        with conn:
+            conn.executemany(update_sql, updates)
+            conn.execute("""UPDATE BackfillJobs SET cursor = ?, processed = processed + ?, updated = updated + ?,
+                skipped = skipped + ?, failed = failed + ? WHERE kind = ?""",
+                         (rows[-1]['rowid'], len(rows), len(updates), skipped, failed, kind))
+        if kind == "order_sizes":
+            with orders_lock:
+                for quantity, size_usdt, order_id in updates:
+                    if order_id in pending_orders:
+                        pending_orders[order_id].update(quantity=quantity, size_usdt=size_usdt)
+        job = backfill_status(conn, kind)
+
+def backfill_worker():
+    conn = None
+    while not shutdown_event.is_set():
+        backfill_event.wait(CONFIG["backfill_poll_interval"])
+        backfill_event.clear()
+        if not owns_background():
+            continue
+        try:
+            if conn is None:
+                conn = get_db_connection()
+            kinds = [row['kind'] for row in conn.execute("SELECT kind FROM BackfillJobs WHERE status IN ('queued', 'running')")]
+        except Exception as e:
+            log_message('ERROR', f"Error loading backfill jobs: {e}")
+            continue
+        for kind in kinds:
+            try:
+                run_backfill(conn, kind)
             except Exception as e:
-                log_message('ERROR', f"Error processing webhook for {user_id}: {e}")
-    return jsonify({"message": "Webhook processed"}), 200
-
-@app.route('/update_order_sizes', methods=['POST'])
+                log_message('ERROR', f"Backfill {kind} failed: {e}")
+                try:
+                    with conn:
+                        conn.execute("UPDATE BackfillJobs SET status = 'failed', error = ?, finished_at = ? WHERE kind = ?",
+                                     (str(e), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), kind))
+                except Exception as e:
+                    log_message('ERROR', f"Error recording backfill failure for {kind}: {e}")
+    if conn is not None:
+        conn.close()
+
+def backfill_response(kind, label):
+    if request.method == 'GET':
+        with get_db_connection() as conn:
+            job = backfill_status(conn, kind)
+        if job is None:
+            return jsonify({"error": f"No {label} backfill has run"}), 404
+        return jsonify({"message": f"{label} backfill is {job['status']}", "job": job}), 200
+    job = enqueue_backfill(kind)
+    if job['status'] == "done":
+        return jsonify({"message": f"{label} are up to date", "job": job}), 200
+    return jsonify({"message": f"{label} backfill {job['status']} ({job['processed']}/{job['total']} rows)", "job": job}), 202
+
+@app.route('/update_order_sizes', methods=['GET', 'POST'])
 @login_required
 def update_order_sizes():
-    with data_lock:
-        for user_id, config in current_config.items():
-            try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT order_id, user_id, symbol, status FROM Orders WHERE size_usdt IS NULL OR size_usdt = 0")
-                    orders = [dict(row) for row in cursor.fetchall()]
-                    for order in orders:
-                        order_id = order['order_id']
-                        symbol = order['symbol']
-                        status = order['status']
-                        try:
-                            price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                            binance_order = client.futures_get_order(symbol=symbol, orderId=order_id)
-                            executed_qty = float(binance_order.get('executedQty', 0))
-                            orig_qty = float(binance_order.get('origQty', 0))
-                            if status == "FILLED" and executed_qty > 0:
-                                size_usdt = executed_qty * price
-                                cursor.execute("UPDATE Orders SET quantity = ?, size_usdt = ? WHERE order_id = ?",
-                                               (executed_qty, size_usdt, order_id))
-                                conn.commit()
-                                log_message('INFO', f"Updated FILLED order {order_id} with quantity {executed_qty}, size_usdt {size_usdt}")
-                            elif status == "NEW" and orig_qty > 0:
-                                size_usdt = orig_qty * price
-                                cursor.execute("UPDATE Orders SET quantity = ?, size_usdt = ? WHERE order_id = ?",
-                                               (orig_qty, size_usdt, order_id))
-                                conn.commit()
-                                log_message('INFO', f"Updated NEW order {order_id} with quantity {orig_qty}, size_usdt {size_usdt}")
-                            else:
-                                log_message('WARNING', f"No valid quantity for order {order_id}, skipping size_usdt update")
-                        except Exception as e:
-                            log_message('ERROR', f"Failed to update size_usdt for order {order_id}: {e}")
-            except Exception as e:
-                log_message('ERROR', f"Error updating order sizes for {user_id}: {e}")
-    return jsonify({"message": "Order sizes updated"}), 200
+    return backfill_response("order_sizes", "Order sizes")
 
-@app.route('/update_closed_position_sizes', methods=['POST'])
+@app.route('/update_closed_position_sizes', methods=['GET', 'POST'])
 @login_required
 def update_closed_position_sizes():
-    with data_lock:
-        for user_id, config in current_config.items():
-            try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT id, user_id, symbol, quantity, entry_price FROM ClosedPositions WHERE size_usdt IS NULL OR size_usdt = 0")
-                    positions = [dict(row) for row in cursor.fetchall()]
-                    for pos in positions:
-                        pos_id = pos['id']
-                        symbol = pos['symbol']
-                        quantity = pos['quantity']
-                        entry_price = pos['entry_price']
-                        try:
-                            if quantity is None or quantity == 0:
-                                log_message('WARNING', f"No quantity for closed position {pos_id}, skipping size_usdt update")
-                                continue
-                            if entry_price is None or entry_price == 0:
-                                entry_price = float(client.get_symbol_ticker(symbol=symbol)['price'])
-                                log_message('INFO', f"Fetched current price {entry_price} for {symbol} as entry price was invalid")
-                                cursor.execute("UPDATE ClosedPositions SET entry_price = ? WHERE id = ?",
-                                               (entry_price, pos_id))
-                            size_usdt = quantity * entry_price
-                            cursor.execute("UPDATE ClosedPositions SET size_usdt = ? WHERE id = ?",
-                                           (size_usdt, pos_id))
-                            conn.commit()
-                            log_message('INFO', f"Updated closed position {pos_id} with size_usdt {size_usdt}")
-                        except Exception as e:
-                            log_message('ERROR', f"Failed to update size_usdt for closed position {pos_id}: {e}")
-            except Exception as e:
-                log_message('ERROR', f"Error updating closed position sizes for {user_id}: {e}")
-    return jsonify({"message": "Closed position sizes updated"}), 200
+    return backfill_response("closed_position_sizes", "Closed position sizes")
 
 @app.route('/')
 @login_required
@@ -609,7 +1986,8 @@ def save_api():
 
     try:
         client = Client(api_key, api_secret, requests_params={"timeout": 20})
-        client.get_account()
+        api_call(client, "get_account", priority=PRIORITY_READ, user_id=user_id)
+        api_call(client, "futures_ping", priority=PRIORITY_READ, user_id=user_id)
     except Exception as e:
         log_message('ERROR', f"Invalid Binance API keys for {user_id}: {e}")
         return jsonify({"error": f"Invalid API keys: {str(e)}"}), 400
@@ -620,10 +1998,11 @@ def save_api():
             (user_id, api_key, api_secret, status, available_fund, live_pnl, multiplier, leverage)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
             (user_id, api_key, api_secret, 1, 0.0, 0.0, multiplier, leverage))
+        bump_shared_version(conn, "config_edits")
         conn.commit()
 
-    with data_lock:
-        current_config[user_id] = {
+    with get_account_lock(user_id):
+        set_account(user_id, {
             "available_fund": 0.0,
             "live_pnl": 0.0,
             "status": 1,
@@ -631,85 +2010,339 @@ def save_api():
             "api_secret": api_secret,
             "multiplier": multiplier,
             "leverage": leverage
-        }
+        })
+    with client_lock:
+        previous = account_clients.get(user_id)
+        account_clients[user_id] = client
+    if previous is not None:
+        previous.close_connection()
     log_message('INFO', f"Saved API credentials for {user_id}")
     return jsonify({"message": "API credentials saved"}), 200
 
 @app.route('/config', methods=['GET'])
 @login_required
-@cache.cached(timeout=10)
 def get_config():
-    failed_users = []
-    with data_lock:
-        for user_id, config in current_config.items():
-            if not config['status']:
-                continue
+    return jsonify([{"user_id": k, **v, "balance_updated_at": balance_snapshots.get(k, {}).get('updated_at')}
+                    for k, v in config_snapshot().items()])
+
+def refresh_account_balance(user_id, config, priority=PRIORITY_BACKGROUND):
+    client = get_client(user_id, config)
+    with orders_lock:
+        generation = order_generations.get(user_id, 0)
+    requested_at = time.time()
+    account = api_call(client, "futures_account", priority=priority, user_id=user_id, defer=priority == PRIORITY_BACKGROUND)
+    snapshot = {
+        "available_fund": float(account['availableBalance']),
+        "live_pnl": float(account['totalUnrealizedProfit']),
+        "updated_at": requested_at
+    }
+    # An order recorded while the request was in flight makes this a pre-order balance, and caching
+    # it would let the next signal size against margin that is already spent
+    with orders_lock:
+        if order_generations.get(user_id, 0) != generation:
+            return snapshot
+        balance_snapshots[user_id] = snapshot
+    if (config['available_fund'], config['live_pnl']) != (snapshot['available_fund'], snapshot['live_pnl']):
+        with get_account_lock(user_id):
+            update_account(user_id, available_fund=snapshot['available_fund'], live_pnl=snapshot['live_pnl'])
+    return snapshot
+
+def get_available_balance(user_id, config):
+    snapshot = balance_snapshots.get(user_id)
+    if snapshot is None or time.time() - snapshot['updated_at'] > CONFIG["balance_max_staleness"]:
+        snapshot = refresh_account_balance(user_id, config, PRIORITY_ORDER)
+    return snapshot['available_fund']
+
+# Spread the accounts across the interval so refreshes never arrive at Binance as one burst
+def balance_updater():
+    warmup_event.wait()
+    while not shutdown_event.is_set():
+        accounts = [(user_id, config) for user_id, config in config_snapshot().items() if config['status']]
+        if not accounts or not owns_background():
+            shutdown_event.wait(CONFIG["balance_update_interval"])
+            continue
+        delay = CONFIG["balance_update_interval"] / len(accounts)
+        for user_id, config in accounts:
             try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-                balance = float(client.futures_account()['availableBalance'])
-                config['available_fund'] = balance
-                config['live_pnl'] = float(client.futures_account()['totalUnrealizedProfit'])
+                refresh_account_balance(user_id, config)
             except Exception as e:
-                failed_users.append(user_id)
-                log_message('ERROR', f"Error fetching config for {user_id}: {str(e)}. Check internet connectivity or Binance API status.")
-        if failed_users:
-            log_message('ERROR', f"Failed to fetch config for users: {', '.join(failed_users)}")
-        return jsonify([{"user_id": k, **v} for k, v in current_config.items()])
+                log_message('ERROR', f"Error refreshing balance for {user_id}: {str(e)}. Check internet connectivity or Binance API status.")
+            publish_balances()
+            if shutdown_event.wait(delay):
+                break
+
+ORDER_COLUMNS = ['order_id', 'user_id', 'symbol', 'side', 'order_type', 'price', 'quantity', 'size_usdt', 'status', 'time']
+CLOSED_POSITION_COLUMNS = ['id', 'user_id', 'symbol', 'quantity', 'size_usdt', 'entry_price', 'exit_price', 'realized_pnl', 'close_time']
+
+# Keyset pagination, newest first: the cursor is the sort key of the last row of the previous page
+def query_page(table, columns, key_columns, time_column):
+    fields = columns
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in columns]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    limit = int(request.args.get('limit', CONFIG["page_size"]))
+    if limit < 1 or limit > CONFIG["max_page_size"]:
+        raise ValueError(f"limit must be between 1 and {CONFIG['max_page_size']}")
+
+    where, params = [], []
+    for column in ('user_id', 'symbol'):
+        if request.args.get(column):
+            where.append(f"{column} = ?")
+            params.append(request.args[column] if column == 'user_id' else request.args[column].upper())
+    if request.args.get('since'):
+        where.append(f"{time_column} >= ?")
+        params.append(request.args['since'])
+    if request.args.get('until'):
+        where.append(f"{time_column} < ?")
+        params.append(request.args['until'])
+    if request.args.get('cursor'):
+        values = request.args['cursor'].split('|')
+        if len(values) != len(key_columns):
+            raise ValueError("Invalid cursor")
+        if key_columns == ("id",):
+            values = [int(values[0])]
+        where.append(f"({', '.join(key_columns)}) < ({', '.join('?' * len(key_columns))})")
+        params.extend(values)
+
+    selected = fields + [c for c in key_columns if c not in fields]
+    sql = f"SELECT {', '.join(selected)} FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {', '.join(c + ' DESC' for c in key_columns)} LIMIT ?"
+    params.append(limit)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = '|'.join(str(rows[-1][c]) for c in key_columns)
+    return [{c: row[c] for c in fields} for row in rows], next_cursor
 
 @app.route('/orders', methods=['GET'])
 @login_required
 def get_orders():
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM Orders")
-        orders = [dict(row) for row in cursor.fetchall()]
-    return jsonify(orders)
+    try:
+        orders, next_cursor = query_page("Orders", ORDER_COLUMNS, ("time", "order_id"), "time")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(orders), 200, {"X-Next-Cursor": next_cursor or ""}
 
 @app.route('/open_positions', methods=['GET'])
 @login_required
 def get_open_positions():
+    positions = open_position_rows()
+    if positions:
+        log_message('INFO', f"Returning {len(positions)} open positions: {[pos['symbol'] for pos in positions]}", chatty=True)
+    else:
+        log_message('INFO', "No open positions found for active users", chatty=True)
+    return jsonify(positions)
+
+# Only non-zero positions are kept, as symbol -> (position_amt, entry_price, mark_price, unrealized_pnl)
+def refresh_account_positions(user_id, config, priority=PRIORITY_BACKGROUND):
+    client = get_client(user_id, config)
+    futures_positions = api_call(client, "futures_position_information", priority=priority, user_id=user_id, defer=priority == PRIORITY_BACKGROUND)
+    positions = {}
+    for pos in futures_positions:
+        position_amt = float(pos['positionAmt'])
+        if position_amt != 0:
+            positions[pos['symbol']] = (position_amt, float(pos['entryPrice']), float(pos['markPrice']),
+                                        float(pos.get('unRealizedProfit', pos.get('unrealizedProfit', 0.0))))
+    position_book[user_id] = {"positions": positions, "updated_at": time.time()}
+    return positions
+
+def get_account_positions(user_id, config, force=False, priority=PRIORITY_ORDER):
+    entry = position_book.get(user_id)
+    if force or entry is None:
+        return refresh_account_positions(user_id, config, priority)
+    return entry['positions']
+
+def open_position_rows():
     positions = []
-    with data_lock:
-        for user_id, config in current_config.items():
-            if not config['status']:
+    for user_id, config in config_snapshot().items():
+        entry = position_book.get(user_id)
+        if not config['status'] or entry is None:
+            continue
+        for symbol, (position_amt, entry_price, mark_price, unrealized_pnl) in entry['positions'].items():
+            mark_price = cached_mark_price(symbol) or mark_price
+            positions.append({
+                "user_id": user_id,
+                "symbol": symbol,
+                "size_usdt": round(position_amt * mark_price, 2),
+                "entry_price": entry_price,
+                "mark_price": mark_price,
+                "unrealized_pnl": unrealized_pnl
+            })
+    publish_event("position_updated", positions, only_changes=True)
+    return positions
+
+# Accounts holding positions are refreshed more often than flat ones
+def position_updater():
+    warmup_event.wait()
+    next_refresh = {}
+    while not shutdown_event.is_set():
+        if not owns_background():
+            next_refresh.clear()
+            shutdown_event.wait(CONFIG["position_scheduler_tick"])
+            continue
+        accounts = {user_id: config for user_id, config in config_snapshot().items() if config['status']}
+        for user_id in set(position_book) - set(accounts):
+            position_book.pop(user_id, None)
+            next_refresh.pop(user_id, None)
+        for user_id, config in accounts.items():
+            entry = position_book.get(user_id)
+            due = next_refresh.get(user_id)
+            if due is None and entry is not None:
+                # Entries primed by warm-up are as good as our own refreshes
+                due = entry['updated_at'] + (CONFIG["open_position_refresh_interval"] if entry['positions'] else CONFIG["position_refresh_interval"])
+            if entry is not None and due > time.time():
                 continue
             try:
-                client = Client(config['api_key'], config['api_secret'], requests_params={"timeout": 20})
-                futures_positions = client.futures_position_information()
-                for pos in futures_positions:
-                    if float(pos['positionAmt']) != 0:
-                        unrealized_pnl = float(pos.get('unRealizedProfit', pos.get('unrealizedProfit', 0.0)))
-                        size_usdt = float(pos['positionAmt']) * float(pos['markPrice'])
-                        position = {
-                            "user_id": user_id,
-                            "symbol": pos['symbol'],
-                            "size_usdt": round(size_usdt, 2),
-                            "entry_price": float(pos['entryPrice']),
-                            "mark_price": float(pos['markPrice']),
-                            "unrealized_pnl": unrealized_pnl
-                        }
-                        positions.append(position)
+                positions = refresh_account_positions(user_id, config)
             except Exception as e:
                 log_message('ERROR', f"Error fetching positions for {user_id}: {str(e)}. Check internet connectivity or Binance API status.")
-    if positions:
-        log_message('INFO', f"Returning {len(positions)} open positions: {[pos['symbol'] for pos in positions]}")
+                positions = None
+            interval = CONFIG["open_position_refresh_interval"] if positions else CONFIG["position_refresh_interval"]
+            next_refresh[user_id] = time.time() + interval
+            if shutdown_event.is_set():
+                break
+        shutdown_event.wait(CONFIG["position_scheduler_tick"])
+
+last_published = {}
+
+# Only the background owner places orders and closes positions, so these go through SharedState
+# to reach dashboards connected to the other workers
+RELAYED_EVENTS = ("order_placed", "position_closed")
+
+def publish_event(event, payload, only_changes=False):
+    data = json.dumps(payload)
+    if only_changes:
+        if last_published.get(event) == data:
+            return
+        last_published[event] = data
+    if event in RELAYED_EVENTS and CONFIG["serve_mode"] == "production":
+        with events_lock:
+            relay_events.append([event, data])
+    broadcast_event(event, data)
+
+def broadcast_event(event, data):
+    message = f"event: {event}\ndata: {data}\n\n"
+    with events_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            pass
+
+def publish_balances():
+    balances = [{"user_id": user_id, "available_fund": config['available_fund'], "live_pnl": config['live_pnl'],
+                 "status": config['status'], "multiplier": config['multiplier'], "leverage": config['leverage']}
+                for user_id, config in config_snapshot().items()]
+    publish_event("balance_refreshed", balances, only_changes=True)
+
+# One producer reprices the position book for every open dashboard, and only while one is connected
+def dashboard_publisher():
+    while not shutdown_event.is_set():
+        shutdown_event.wait(CONFIG["event_refresh_interval"])
+        if not event_subscribers:
+            continue
+        try:
+            open_position_rows()
+        except Exception as e:
+            log_message('ERROR', f"Error refreshing dashboard state: {e}")
+
+# Left open like /webhook so Prometheus can scrape without a session; it exposes counts only
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if CONFIG["serve_mode"] == "production":
+        snapshots = worker_metrics()
     else:
-        log_message('INFO', "No open positions found for active users")
-    return jsonify(positions)
+        snapshots = [((), metrics_snapshot())]
+    return Response(render_metrics(snapshots), mimetype='text/plain; version=0.0.4')
+
+@app.route('/events', methods=['GET'])
+@login_required
+def events():
+    subscriber = queue.Queue(maxsize=CONFIG["event_queue_size"])
+    with events_lock:
+        event_subscribers.append(subscriber)
+    # New dashboards get the current state immediately instead of waiting for the next change
+    last_published.pop("balance_refreshed", None)
+    last_published.pop("position_updated", None)
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not shutdown_event.is_set():
+                try:
+                    yield subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            with events_lock:
+                event_subscribers.remove(subscriber)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/closed_positions', methods=['GET'])
 @login_required
 def get_closed_positions():
+    try:
+        closed_positions, next_cursor = query_page("ClosedPositions", CLOSED_POSITION_COLUMNS, ("id",), "close_time")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(closed_positions), 200, {"X-Next-Cursor": next_cursor or ""}
+
+PNL_GROUP_COLUMNS = ['user_id', 'symbol', 'day']
+
+# Reads only the per user/symbol/day rollup, so the cost follows the number of groups, not of trades
+@app.route('/pnl_summary', methods=['GET'])
+@login_required
+def pnl_summary():
+    group_by = [c.strip() for c in request.args.get('group_by', 'user_id,symbol').split(',') if c.strip()]
+    unknown = [c for c in group_by if c not in PNL_GROUP_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"Unknown group_by columns: {', '.join(unknown)}"}), 400
+    where, params = [], []
+    for column in ('user_id', 'symbol'):
+        if request.args.get(column):
+            where.append(f"{column} = ?")
+            params.append(request.args[column] if column == 'user_id' else request.args[column].upper())
+    if request.args.get('since'):
+        where.append("day >= ?")
+        params.append(request.args['since'][:10])
+    if request.args.get('until'):
+        where.append("day < ?")
+        params.append(request.args['until'][:10])
+    sql = f"""SELECT {''.join(c + ', ' for c in group_by)}SUM(trades) AS trades, SUM(wins) AS wins, SUM(losses) AS losses,
+        SUM(realized_pnl) AS realized_pnl, SUM(gross_profit) AS gross_profit, SUM(gross_loss) AS gross_loss FROM PnlRollup"""
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM ClosedPositions")
-        closed_positions = [dict(row) for row in cursor.fetchall()]
-    return jsonify(closed_positions)
+        rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+    # An ungrouped total over no matching rows comes back as a single row of NULLs
+    return jsonify([row for row in rows if row['trades']]), 200
 
 @app.route('/sync_closed_positions', methods=['POST'])
 @login_required
 def manual_sync_closed_positions():
-    sync_closed_positions()
+    if not owns_background():
+        with get_db_connection() as conn:
+            bump_shared_version(conn, "sync_requests")
+        return jsonify({"message": "Closed position sync queued on the background worker"}), 202
+    # Two passes over the same cursors would match one exit fill against two lots
+    if not sync_lock.acquire(blocking=False):
+        return jsonify({"message": "Closed position sync is already running"}), 409
+    try:
+        sync_closed_positions()
+    finally:
+        sync_lock.release()
     return jsonify({"message": "Closed positions synced"}), 200
 
 @app.route('/update_status', methods=['POST'])
@@ -717,12 +2350,12 @@ def manual_sync_closed_positions():
 def update_status():
     user_id = request.json['user_id']
     status = int(request.json['status'])
-    with data_lock:
-        if user_id in current_config:
-            current_config[user_id]['status'] = status
+    with get_account_lock(user_id):
+        if update_account(user_id, status=status):
             with get_db_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("UPDATE Config SET status = ? WHERE user_id = ?", (status, user_id))
+                bump_shared_version(conn, "config_edits")
                 conn.commit()
             log_message('INFO', f"Updated status for {user_id} to {status}")
             return jsonify({"message": "Status updated"}), 200
@@ -735,12 +2368,12 @@ def update_multiplier():
     multiplier = float(request.json['multiplier'])
     if multiplier < 0:
         return jsonify({"error": "Multiplier must be non-negative"}), 400
-    with data_lock:
-        if user_id in current_config:
-            current_config[user_id]['multiplier'] = multiplier
+    with get_account_lock(user_id):
+        if update_account(user_id, multiplier=multiplier):
             with get_db_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("UPDATE Config SET multiplier = ? WHERE user_id = ?", (multiplier, user_id))
+                bump_shared_version(conn, "config_edits")
                 conn.commit()
             log_message('INFO', f"Updated multiplier for {user_id} to {multiplier}")
             return jsonify({"message": "Multiplier updated"}), 200
@@ -753,12 +2386,12 @@ def update_leverage():
     leverage = int(request.json['leverage'])
     if leverage < 1:
         return jsonify({"error": "Leverage must be at least 1"}), 400
-    with data_lock:
-        if user_id in current_config:
-            current_config[user_id]['leverage'] = leverage
+    with get_account_lock(user_id):
+        if update_account(user_id, leverage=leverage):
             with get_db_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("UPDATE Config SET leverage = ? WHERE user_id = ?", (leverage, user_id))
+                bump_shared_version(conn, "config_edits")
                 conn.commit()
             log_message('INFO', f"Updated leverage for {user_id} to {leverage}")
             return jsonify({"message": "Leverage updated"}), 200
@@ -768,26 +2401,28 @@ def update_leverage():
 @login_required
 def delete_account():
     user_id = request.json['user_id']
-    with data_lock:
-        if user_id in current_config:
-            del current_config[user_id]
+    with get_account_lock(user_id):
+        if remove_account(user_id):
+            drop_client(user_id)
             with get_db_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("DELETE FROM Config WHERE user_id = ?", (user_id,))
+                bump_shared_version(conn, "config_edits")
                 conn.commit()
             log_message('INFO', f"Deleted account for {user_id}")
             return jsonify({"message": "Account deleted"}), 200
     return jsonify({"error": "User not found"}), 404
 
 def read_api_keys(db_file="trading_data.db"):
+    global current_config
+    loaded = {}
     with get_db_connection(db_file) as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, api_key, api_secret, status, available_fund, live_pnl, multiplier, leverage FROM Config")
-        current_config.clear()
         for row in cursor.fetchall():
             if all([row[1], row[2]]):
                 user_id = row[0]
-                current_config[user_id] = {
+                loaded[user_id] = {
                     "available_fund": float(row[4] or 0.0),
                     "live_pnl": float(row[5] or 0.0),
                     "status": int(row[3] or 1),
@@ -796,19 +2431,355 @@ def read_api_keys(db_file="trading_data.db"):
                     "multiplier": float(row[6] or 1.0),
                     "leverage": int(row[7] or 1)
                 }
+    with config_lock:
+        current_config = loaded
+    prune_clients(loaded)
     log_message('INFO', "Loaded API keys from database")
 
+def set_warmup_stage(stage):
+    warmup_state["stage"] = stage
+    log_message('INFO', f"Warm-up: {stage} ({time.time() - warmup_state['started_at']:.1f}s)")
+
+def warm_up():
+    warmup_state["started_at"] = time.time()
+    try:
+        if CONFIG["serve_mode"] == "production":
+            lease_checked.wait(CONFIG["lease_ttl"])
+        # Followers get symbol filters, balances and positions from SharedState instead of Binance
+        owner = owns_background()
+        set_warmup_stage("exchange_info")
+        if owner:
+            try:
+                load_exchange_info()
+            except Exception as e:
+                warmup_state["errors"].append(f"exchange_info: {e}")
+                log_message('ERROR', f"Failed to load futures exchange info: {e}")
+
+            set_warmup_stage("clients")
+            build_account_clients(list(config_snapshot().items()))
+
+        set_warmup_stage("mark_prices")
+        try:
+            poll_mark_prices()
+        except Exception as e:
+            warmup_state["errors"].append(f"mark_prices: {e}")
+            log_message('ERROR', f"Failed to prime mark prices: {e}")
+
+        set_warmup_stage("accounts")
+        accounts = [(user_id, config) for user_id, config in config_snapshot().items() if config['status']] if owner else []
+        warmup_state["accounts_total"] = len(accounts)
+
+        def prime(item):
+            user_id, config = item
+            try:
+                refresh_account_balance(user_id, config, PRIORITY_READ)
+                refresh_account_positions(user_id, config, PRIORITY_READ)
+            except Exception as e:
+                warmup_state["errors"].append(f"{user_id}: {e}")
+                log_message('ERROR', f"Failed to prime balance and positions for {user_id}: {e}")
+            with warmup_lock:
+                warmup_state["accounts_done"] += 1
+                done = warmup_state["accounts_done"]
+            if done % 10 == 0 or done == len(accounts):
+                log_message('INFO', f"Warm-up: primed {done}/{len(accounts)} accounts")
+
+        list(order_executor.map(prime, accounts))
+    finally:
+        warmup_state["finished_at"] = time.time()
+        set_warmup_stage("done")
+        warmup_event.set()
+
+# Open like /webhook so the tunnel or load balancer can poll it; ready once warm-up is over
+# and symbol filters are loaded, since every futures signal is rejected without them
+@app.route('/ready', methods=['GET'])
+def ready():
+    is_ready = warmup_event.is_set() and bool(exchange_info_cache)
+    body = {"ready": is_ready, **warmup_state}
+    body["errors"] = list(warmup_state["errors"])
+    return jsonify(body), 200 if is_ready else 503
+
+# Production serving runs several worker processes (see gunicorn.conf.py). They share the
+# database; one of them holds the "background" lease and is the only one that trades, polls
+# Binance and flushes state, publishing config and positions to SharedState for the others.
+def owns_background():
+    return CONFIG["serve_mode"] != "production" or owner_event.is_set()
+
+def acquire_lease(conn, name, ttl):
+    now = time.time()
+    with conn:
+        conn.execute("""INSERT INTO Leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE Leases.owner = excluded.owner OR Leases.expires_at < ?""", (name, WORKER_ID, now + ttl, now))
+    return conn.execute("SELECT owner FROM Leases WHERE name = ?", (name,)).fetchone()[0] == WORKER_ID
+
+def release_lease(name, db_file="trading_data.db"):
+    with get_db_connection(db_file) as conn:
+        conn.execute("DELETE FROM Leases WHERE name = ? AND owner = ?", (name, WORKER_ID))
+
+def become_owner():
+    # Settings may have changed while this worker was following, the database is the source of truth
+    read_api_keys()
+    load_trade_cursors()
+    load_open_lots()
+    published_state.clear()
+    abandoned = json.dumps({"error": "Worker executing the job stopped"})
+    with get_db_connection() as conn:
+        # Retries of these alerts would otherwise be told "already accepted" until the key expires
+        conn.execute("""UPDATE WebhookKeys SET status_code = 500, result = ?
+            WHERE result IS NULL AND job_id IN (SELECT job_id FROM Jobs WHERE status = 'running')""", (abandoned,))
+        conn.execute("""UPDATE Jobs SET status = 'failed', status_code = 500, result = ?, finished_at = ?
+            WHERE status = 'running'""", (abandoned, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        shared_versions["config_edits"] = read_shared_version(conn, "config_edits")
+        shared_versions["sync_requests"] = read_shared_version(conn, "sync_requests")
+    # Catch up on exits the previous owner missed, including any sync another worker asked it for
+    sync_event.set()
+
+def lease_keeper():
+    conn = get_db_connection()
+    renewed_at = 0.0
+    while not shutdown_event.is_set():
+        try:
+            attempted_at = time.time()
+            owner = acquire_lease(conn, "background", CONFIG["lease_ttl"])
+            if owner:
+                renewed_at = attempted_at
+            if owner and not owner_event.is_set():
+                become_owner()
+                owner_event.set()
+                log_message('INFO', f"Worker {WORKER_ID} took over the background loops")
+            elif not owner and owner_event.is_set():
+                owner_event.clear()
+                log_message('ERROR', f"Worker {WORKER_ID} lost the background lease")
+        except Exception as e:
+            log_message('ERROR', f"Error renewing background lease: {e}")
+        # Another worker may take the lease once it expires, so stop trading well before that
+        if owner_event.is_set() and time.time() - renewed_at > CONFIG["lease_ttl"] / 2:
+            owner_event.clear()
+            log_message('ERROR', f"Worker {WORKER_ID} could not renew the background lease, stopping the background loops")
+        lease_checked.set()
+        shutdown_event.wait(CONFIG["lease_ttl"] / 3)
+    if owner_event.is_set():
+        release_lease("background")
+    conn.close()
+
+def bump_shared_version(conn, key):
+    conn.execute("""INSERT INTO SharedState (key, version, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(key) DO UPDATE SET version = SharedState.version + 1, updated_at = excluded.updated_at""",
+                 (key, time.time()))
+
+def read_shared_version(conn, key):
+    row = conn.execute("SELECT version FROM SharedState WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def publish_shared_state(conn):
+    edits = read_shared_version(conn, "config_edits")
+    if edits != shared_versions.get("config_edits"):
+        shared_versions["config_edits"] = edits
+        read_api_keys()
+    requested = read_shared_version(conn, "sync_requests")
+    if requested != shared_versions.get("sync_requests"):
+        shared_versions["sync_requests"] = requested
+        sync_event.set()
+    # Filters only change when the refresher reloads them, so they are published by load time
+    if exchange_info_cache and published_state.get("exchange_info") != exchange_info_loaded_at:
+        with conn:
+            conn.execute("""INSERT INTO SharedState (key, version, payload, updated_at) VALUES ('exchange_info', 1, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET version = SharedState.version + 1, payload = excluded.payload,
+                updated_at = excluded.updated_at""", (json.dumps(exchange_info_cache), time.time()))
+        published_state["exchange_info"] = exchange_info_loaded_at
+    payloads = {
+        "config": {"accounts": config_snapshot(), "balances": dict(balance_snapshots)},
+        "positions": dict(position_book)
+    }
+    for key, payload in payloads.items():
+        text = json.dumps(payload, sort_keys=True)
+        if text == published_state.get(key):
+            continue
+        with conn:
+            conn.execute("""INSERT INTO SharedState (key, version, payload, updated_at) VALUES (?, 1, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET version = SharedState.version + 1, payload = excluded.payload,
+                updated_at = excluded.updated_at""", (key, text, time.time()))
+        published_state[key] = text
+    publish_relay_events(conn)
+
+# Relayed events keep a rolling window tagged with the version that wrote them, so a follower that
+# skipped a version still replays everything newer than the last one it saw
+def publish_relay_events(conn):
+    with events_lock:
+        events = relay_events[:]
+        del relay_events[:]
+    if not events:
+        return
+    try:
+        with conn:
+            row = conn.execute("SELECT version, payload FROM SharedState WHERE key = 'events'").fetchone()
+            version = (row['version'] if row else 0) + 1
+            window = json.loads(row['payload']) if row and row['payload'] else []
+            window = (window + [[version, event, data] for event, data in events])[-CONFIG["event_relay_size"]:]
+            conn.execute("""INSERT INTO SharedState (key, version, payload, updated_at) VALUES ('events', ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET version = excluded.version, payload = excluded.payload,
+                updated_at = excluded.updated_at""", (version, json.dumps(window), time.time()))
+    except Exception:
+        with events_lock:
+            relay_events[:0] = events
+        raise
+
+def load_shared_state(conn):
+    global current_config, exchange_info_cache, exchange_info_loaded_at
+    for key, version, payload in conn.execute("""SELECT key, version, payload FROM SharedState
+            WHERE key IN ('config', 'positions', 'events', 'exchange_info')"""):
+        if version == shared_versions.get(key) or payload is None:
+            continue
+        last_seen = shared_versions.get(key)
+        shared_versions[key] = version
+        state = json.loads(payload)
+        if key == "events":
+            for event_version, event, data in state:
+                if event_version > last_seen:
+                    broadcast_event(event, data)
+        elif key == "exchange_info":
+            for filters in state.values():
+                filters['step'] = tuple(filters['step'])
+            exchange_info_cache = state
+            exchange_info_loaded_at = time.time()
+        elif key == "config":
+            with config_lock:
+                current_config = state["accounts"]
+            prune_clients(current_config)
+            balance_snapshots.clear()
+            balance_snapshots.update(state["balances"])
+            publish_balances()
+        else:
+            for user_id in set(position_book) - set(state):
+                position_book.pop(user_id, None)
+            position_book.update(state)
+
+def shared_state_sync():
+    conn = get_db_connection()
+    # Events from before this worker started are history, not news
+    shared_versions["events"] = read_shared_version(conn, "events")
+    metrics_published_at = 0.0
+    while not shutdown_event.is_set():
+        try:
+            if owner_event.is_set():
+                publish_shared_state(conn)
+            else:
+                load_shared_state(conn)
+            if time.time() - metrics_published_at >= CONFIG["metrics_publish_interval"]:
+                publish_metrics(conn)
+                metrics_published_at = time.time()
+        except Exception as e:
+            log_message('ERROR', f"Error syncing shared state: {e}")
+        shutdown_event.wait(CONFIG["shared_state_interval"])
+    conn.close()
+
+def submit_shared_job(job):
+    with get_db_connection() as conn:
+        queued = conn.execute("SELECT COUNT(*) FROM Jobs WHERE status = 'queued'").fetchone()[0]
+        if queued >= CONFIG["webhook_queue_size"]:
+            log_message('ERROR', f"Webhook queue is full ({queued} jobs), rejecting signal: {job['data']}")
+            return jsonify({"error": "Webhook queue is full, retry later"}), 503, {"Retry-After": "1"}
+        conn.execute("""INSERT INTO Jobs (job_id, status, action, market, data, submitted_at, queued_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""", (job['job_id'], job['status'], job['action'], job['market'],
+                                             json.dumps(job['data']), job['submitted_at'], job['queued_at']))
+        conn.commit()
+    return jsonify({"message": "Webhook accepted", "job_id": job['job_id']}), 202
+
+def load_shared_job(job_id):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT * FROM Jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['queue_depth'] = conn.execute("SELECT COUNT(*) FROM Jobs WHERE status = 'queued'").fetchone()[0]
+    job['data'] = json.loads(job['data'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+def shared_job_dispatcher():
+    conn = get_db_connection()
+    while not shutdown_event.is_set():
+        if not owner_event.is_set():
+            shutdown_event.wait(CONFIG["lease_ttl"] / 3)
+            continue
+        try:
+            with conn:
+                row = conn.execute("""UPDATE Jobs SET status = 'running' WHERE job_id = (
+                    SELECT job_id FROM Jobs WHERE status = 'queued' ORDER BY queued_at LIMIT 1)
+                    RETURNING job_id, action, market, data, queued_at""").fetchone()
+        except Exception as e:
+            log_message('ERROR', f"Error claiming webhook job: {e}")
+            row = None
+        if row is None:
+            shutdown_event.wait(CONFIG["shared_job_poll_interval"])
+            continue
+        jobs = [dict(row, data=json.loads(row['data']))]
+        key = coalesce_key(jobs[0])
+        if key is not None:
+            # Wait out the window from the first signal's arrival, then take every later signal for the
+            # same symbol that is not queued behind a close_all
+            shutdown_event.wait(max(row['queued_at'] + CONFIG["coalesce_window"] - time.time(), 0))
+            try:
+                with conn:
+                    rows = conn.execute("""UPDATE Jobs SET status = 'running' WHERE status = 'queued'
+                        AND action IN ('trade', 'close') AND market = ? AND upper(json_extract(data, '$.symbol')) = ?
+                        AND queued_at <= ? AND queued_at < COALESCE((SELECT MIN(queued_at) FROM Jobs
+                            WHERE status = 'queued' AND action NOT IN ('trade', 'close')), 1e18)
+                        RETURNING job_id, action, market, data, queued_at""",
+                                        (key[1], key[0], row['queued_at'] + CONFIG["coalesce_window"])).fetchall()
+                jobs += sorted((dict(r, data=json.loads(r['data'])) for r in rows), key=lambda job: job['queued_at'])
+            except Exception as e:
+                log_message('ERROR', f"Error claiming webhook jobs for {key[0]}: {e}")
+        for job in jobs:
+            observe("tv2_webhook_queue_wait_seconds", time.time() - job['queued_at'])
+        outcomes = execute_jobs(jobs)
+        try:
+            with conn:
+                finished_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                conn.executemany("UPDATE Jobs SET status = ?, status_code = ?, result = ?, finished_at = ? WHERE job_id = ?",
+                                 [("done" if status_code == 200 else "failed", status_code, json.dumps(body), finished_at,
+                                   job['job_id']) for job, body, status_code in outcomes])
+                conn.execute("""DELETE FROM Jobs WHERE status IN ('done', 'failed') AND job_id NOT IN (
+                    SELECT job_id FROM Jobs ORDER BY queued_at DESC LIMIT ?)""", (CONFIG["max_tracked_jobs"],))
+        except Exception as e:
+            log_message('ERROR', f"Error recording result of webhook jobs {[job['job_id'] for job in jobs]}: {e}")
+        for job, body, status_code in outcomes:
+            record_idempotent_result(job['job_id'], status_code, body)
+    conn.close()
+
+def start_background_threads():
+    targets = [warm_up, db_updater, sync_closed_positions_periodically, client_keepalive, exchange_info_refresher,
+               mark_price_stream, dashboard_publisher, balance_updater, position_updater, backfill_worker]
+    if CONFIG["serve_mode"] == "production":
+        targets += [lease_keeper, shared_state_sync, shared_job_dispatcher]
+    else:
+        targets.append(webhook_dispatcher)
+    for target in targets:
+        thread = threading.Thread(target=target, name=target.__name__)
+        thread.daemon = True
+        thread.start()
+
+# Entry point for each production worker process, called from gunicorn.conf.py
+def start_worker():
+    CONFIG["serve_mode"] = "production"
+    atexit.register(release_lease, "background")
+    atexit.register(shutdown_event.set)
+    initialize_database()
+    read_api_keys()
+    load_trade_cursors()
+    start_background_threads()
+    log_message('INFO', f"Worker {WORKER_ID} started")
+
 def main():
     initialize_database()
     read_api_keys()
-    db_thread = threading.Thread(target=db_updater, args=("trading_data.db",))
-    db_thread.daemon = True
-    db_thread.start()
-    sync_thread = threading.Thread(target=sync_closed_positions_periodically)
-    sync_thread.daemon = True
-    sync_thread.start()
+    load_trade_cursors()
+    load_open_lots()
+    release_unfinished_idempotency_keys()
+    start_background_threads()
     log_message('INFO', "Starting server on http://0.0.0.0:5000")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # The reloader would start a second process running its own copy of the background threads
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,11 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from concurrent_log_handler import ConcurrentRotatingFileHandler
-import threading
 from binance.client import Client
 
-# Set up a single logger with a lock to prevent concurrent logging
+# Producers only enqueue; a single listener thread formats, writes and rotates
 logger = logging.getLogger('trading_app')
 logger.setLevel(logging.INFO)
 handler = ConcurrentRotatingFileHandler('trading_data.log', maxBytes=10*1024*1024, backupCount=5)
@@ -11,18 +13,14 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.addHandler(stream_handler)
-
-# Add a lock to the logger to prevent concurrent writes
-log_lock = threading.Lock()
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, handler, stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 def log_message(level, message):
-    with log_lock:
-        if level == 'INFO':
-            logger.info(message)
-        elif level == 'ERROR':
-            logger.error(message)
+    logger.log(logging.getLevelName(level), message)
 
 def place_order(client: Client, order_data: dict, multiplier: float) -> str:
     """Place an order on Binance Futures."""
@@ -37,17 +35,26 @@ def place_order(client: Client, order_data: dict, multiplier: float) -> str:
     )
     return str(order['orderId'])
 
-def close_all_positions(client: Client, user_id: str, sio):
-    """Close all open positions for a user."""
+# Binance accepts at most 5 orders per futures batch request
+BATCH_ORDER_SIZE = 5
+
+def close_all_positions(client: Client, user_id: str, sio) -> list:
+    """Close all open positions for a user in reduce-only batches and return the placed order ids."""
     positions = client.futures_position_information()
-    for pos in positions:
-        if float(pos['positionAmt']) != 0:
-            side = 'SELL' if float(pos['positionAmt']) > 0 else 'BUY'
-            order = client.futures_create_order(
-                symbol=pos['symbol'],
-                side=side,
-                type='MARKET',
-                quantity=abs(float(pos['positionAmt'])),
-                reduceOnly=True
-            )
-    sio.emit('positions', {})
\ No newline at end of file
+    orders = [{
+        'symbol': pos['symbol'],
+        'side': 'SELL' if float(pos['positionAmt']) > 0 else 'BUY',
+        'type': 'MARKET',
+        'quantity': pos['positionAmt'].lstrip('-'),
+        'reduceOnly': 'true'
+    } for pos in positions if float(pos['positionAmt']) != 0]
+    order_ids = []
+    for start in range(0, len(orders), BATCH_ORDER_SIZE):
+        batch = orders[start:start + BATCH_ORDER_SIZE]
+        for order, response in zip(batch, client.futures_place_batch_order(batchOrders=batch)):
+            if 'orderId' in response:
+                order_ids.append(str(response['orderId']))
+            else:
+                log_message('ERROR', f"Failed to close {order['symbol']} for {user_id}: {response.get('msg', response)}")
+    sio.emit('positions', {})
+    return order_ids
\ No newline at end of file